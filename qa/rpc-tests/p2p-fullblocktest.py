@@ -32,7 +32,7 @@ class CBrokenBlock(CBlock):
         super(CBrokenBlock, self).__init__(header)
 
     def initialize(self, base_block):
-        self.vtx = copy.deepcopy(base_block.vtx)
+        self.vtx = [CTransaction(tx) for tx in base_block.vtx]
         self.hashMerkleRoot = self.calc_merkle_root()
 
     def serialize(self):
@@ -359,24 +359,24 @@ class FullBlockTest(ComparisonTestFramework):
         tip(15)
         b23 = block(23, spend=out[6])
         tx = CTransaction()
-        script_length = MAX_BLOCK_BASE_SIZE - len(b23.serialize()) - 69
+        script_length = MAX_BLOCK_BASE_SIZE - b23.get_serialized_size() - 69
         script_output = CScript([b'\x00' * script_length])
         tx.vout.append(CTxOut(0, script_output))
         tx.vin.append(CTxIn(COutPoint(b23.vtx[1].sha256, 0)))
         b23 = update_block(23, [tx])
         # Make sure the math above worked out to produce a max-sized block
-        assert_equal(len(b23.serialize()), MAX_BLOCK_BASE_SIZE)
+        assert_equal(b23.get_serialized_size(), MAX_BLOCK_BASE_SIZE)
         yield accepted()
         save_spendable_output()
 
         # Make the next block one byte bigger and check that it fails
         tip(15)
         b24 = block(24, spend=out[6])
-        script_length = MAX_BLOCK_BASE_SIZE - len(b24.serialize()) - 69
+        script_length = MAX_BLOCK_BASE_SIZE - b24.get_serialized_size() - 69
         script_output = CScript([b'\x00' * (script_length+1)])
         tx.vout = [CTxOut(0, script_output)]
         b24 = update_block(24, [tx])
-        assert_equal(len(b24.serialize()), MAX_BLOCK_BASE_SIZE+1)
+        assert_equal(b24.get_serialized_size(), MAX_BLOCK_BASE_SIZE+1)
         yield rejected(RejectResult(16, b'bad-blk-length'))
 
         block(25, spend=out[7])
@@ -522,12 +522,12 @@ class FullBlockTest(ComparisonTestFramework):
         # Until block is full, add tx's with 1 satoshi to p2sh_script, the rest to OP_TRUE
         tx_new = None
         tx_last = tx
-        total_size=len(b39.serialize())
+        total_size=b39.get_serialized_size()
         while(total_size < MAX_BLOCK_BASE_SIZE):
             tx_new = create_tx(tx_last, 1, 1, p2sh_script)
             tx_new.vout.append(CTxOut(tx_last.vout[1].nValue - 1, CScript([OP_TRUE])))
             tx_new.rehash()
-            total_size += len(tx_new.serialize())
+            total_size += tx_new.get_serialized_size()
             if total_size >= MAX_BLOCK_BASE_SIZE:
                 break
             b39.vtx.append(tx_new) # add tx to block
@@ -914,9 +914,9 @@ class FullBlockTest(ComparisonTestFramework):
 
         tip(60)
         b64 = CBlock(b64a)
-        b64.vtx = copy.deepcopy(b64a.vtx)
+        b64.vtx = [CTransaction(tx) for tx in b64a.vtx]
         assert_equal(b64.hash, b64a.hash)
-        assert_equal(len(b64.serialize()), MAX_BLOCK_BASE_SIZE)
+        assert_equal(b64.get_serialized_size(), MAX_BLOCK_BASE_SIZE)
         self.blocks[64] = b64
         update_block(64, [])
         yield accepted()
@@ -1250,12 +1250,12 @@ class FullBlockTest(ComparisonTestFramework):
             for i in range(89, LARGE_REORG_SIZE + 89):
                 b = block(i, spend)
                 tx = CTransaction()
-                script_length = MAX_BLOCK_BASE_SIZE - len(b.serialize()) - 69
+                script_length = MAX_BLOCK_BASE_SIZE - b.get_serialized_size() - 69
                 script_output = CScript([b'\x00' * script_length])
                 tx.vout.append(CTxOut(0, script_output))
                 tx.vin.append(CTxIn(COutPoint(b.vtx[1].sha256, 0)))
                 b = update_block(i, [tx])
-                assert_equal(len(b.serialize()), MAX_BLOCK_BASE_SIZE)
+                assert_equal(b.get_serialized_size(), MAX_BLOCK_BASE_SIZE)
                 test1.blocks_and_transactions.append([self.tip, True])
                 save_spendable_output()
                 spend = get_spendable_output()
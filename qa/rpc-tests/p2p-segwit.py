@@ -178,8 +178,8 @@ def GetP2PKHScript(pubkeyhash):
     return CScript([CScriptOp(OP_DUP), CScriptOp(OP_HASH160), pubkeyhash, CScriptOp(OP_EQUALVERIFY), CScriptOp(OP_CHECKSIG)])
 
 # Add signature for a P2PK witness program.
-def sign_P2PK_witness_input(script, txTo, inIdx, hashtype, value, key):
-    tx_hash = SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, value)
+def sign_P2PK_witness_input(script, txTo, inIdx, hashtype, value, key, cache=None):
+    tx_hash = SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, value, cache)
     signature = key.sign(tx_hash) + chr(hashtype).encode('latin-1')
     txTo.wit.vtxinwit[inIdx].scriptWitness.stack = [signature, script]
     txTo.rehash()
@@ -1404,13 +1404,14 @@ class SegWitTest(BitcoinTestFramework):
             split_value = total_value // num_outputs
             for i in range(num_outputs):
                 tx.vout.append(CTxOut(split_value, scriptPubKey))
+            cache = PrecomputedTransactionData(tx)
             for i in range(num_inputs):
                 # Now try to sign each input, using a random hashtype.
                 anyonecanpay = 0
                 if random.randint(0, 1):
                     anyonecanpay = SIGHASH_ANYONECANPAY
                 hashtype = random.randint(1, 3) | anyonecanpay
-                sign_P2PK_witness_input(witness_program, tx, i, hashtype, temp_utxos[i].nValue, key)
+                sign_P2PK_witness_input(witness_program, tx, i, hashtype, temp_utxos[i].nValue, key, cache)
                 if (hashtype == SIGHASH_SINGLE and i >= num_outputs):
                     used_sighash_single_out_of_bounds = True
             tx.rehash()
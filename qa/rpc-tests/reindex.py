@@ -2,19 +2,23 @@
 # Copyright (c) 2014-2016 The Bitcoin Core developers
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
-"""Test running bitcoind with -reindex and -reindex-chainstate options.
+"""Test running bitcoind with -loadblock, -reindex and -reindex-chainstate options.
 
-- Start a single node and generate 3 blocks.
+- Build 200 blocks offline and restart the node with -loadblock. Verify that the node has imported them.
+- Generate 3 blocks.
 - Stop the node and restart it with -reindex. Verify that the node has reindexed up to block 3.
 - Stop the node and restart it with -reindex-chainstate. Verify that the node has reindexed up to block 3.
 """
 
 from test_framework.test_framework import BitcoinTestFramework
+from test_framework.blocktools import ChainBuilder
 from test_framework.util import (
+    start_node_from_block_files,
     start_nodes,
     stop_nodes,
     assert_equal,
 )
+import os
 import time
 
 class ReindexTest(BitcoinTestFramework):
@@ -27,6 +31,15 @@ class ReindexTest(BitcoinTestFramework):
     def setup_network(self):
         self.nodes = start_nodes(self.num_nodes, self.options.tmpdir)
 
+    def loadblock(self):
+        chain = ChainBuilder()
+        chain.add_blocks(200)
+        block_files = chain.write_block_files(os.path.join(self.options.tmpdir, "import"))
+        stop_nodes(self.nodes)
+        self.nodes = [start_node_from_block_files(0, self.options.tmpdir, block_files, chain.height)]
+        assert_equal(self.nodes[0].getbestblockhash(), chain.blocks[-1].hash)
+        self.log.info("Success")
+
     def reindex(self, justchainstate=False):
         self.nodes[0].generate(3)
         blockcount = self.nodes[0].getblockcount()
@@ -39,6 +52,7 @@ class ReindexTest(BitcoinTestFramework):
         self.log.info("Success")
 
     def run_test(self):
+        self.loadblock()
         self.reindex(False)
         self.reindex(True)
         self.reindex(False)
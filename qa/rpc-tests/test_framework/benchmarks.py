@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Micro-benchmarks for the test framework.
+
+These don't need a running bitcoind.  Run them from qa/rpc-tests with
+
+    python3 -m test_framework.benchmarks [name ...]
+
+Without arguments every benchmark is run.
+"""
+
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from .mininode import *
+from . import siphash
+
+def _witness(cls, i):
+    w = cls()
+    w.scriptWitness.stack = [b"\x01" * 72, b"\x02" * 33]
+    return w
+
+def _script_witness(cls, i):
+    w = cls()
+    w.stack = [b"\x01" * 72, b"\x02" * 33]
+    return w
+
+def _header(cls, i):
+    h = cls()
+    h.nNonce = i
+    return h
+
+def _transaction(cls, i):
+    tx = cls()
+    tx.vin.append(CTxIn(COutPoint(i << 200, 0), b"\x00" * 72, 0xffffffff))
+    tx.vout.append(CTxOut(i, b"\x51" * 25))
+    tx.vout.append(CTxOut(i, b"\x51" * 25))
+    return tx
+
+# How to build an instance number i of each mininode class, given the class
+_SAMPLE_OBJECTS = [
+    (COutPoint, lambda cls, i: cls(i << 200, i)),
+    (CTxIn, lambda cls, i: cls(COutPoint(i << 200, i), b"\x00" * 72, 0xffffffff)),
+    (CTxOut, lambda cls, i: cls(i, b"\x51" * 25)),
+    (CScriptWitness, _script_witness),
+    (CTxInWitness, _witness),
+    (CInv, lambda cls, i: cls(1, i << 200)),
+    (CAddress, lambda cls, i: cls()),
+    (CBlockHeader, _header),
+    (CTransaction, _transaction),
+]
+
+def _dict_class(cls):
+    """A copy of cls without __slots__, whose instances have a __dict__."""
+    slots = getattr(cls, "__slots__", ())
+    names = {k: v for k, v in vars(cls).items()
+             if k not in slots and k not in ("__slots__", "__dict__", "__weakref__")}
+    return type(cls.__name__, (object,), names)
+
+def _bytes_per_object(cls, build, count):
+    """Memory taken by count objects built by build(cls, i), after they have
+    been serialized and hashed as a test would, divided by count."""
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    objs = [build(cls, i) for i in range(count)]
+    for o in objs:
+        if hasattr(o, "serialize"):
+            o.serialize()
+        if hasattr(o, "rehash"):
+            o.rehash()
+    size = tracemalloc.get_traced_memory()[0] - start - sys.getsizeof(objs)
+    tracemalloc.stop()
+    return size / count
+
+def bench_slots_memory(count=20000):
+    """Bytes per object, including what it owns, without and with __slots__."""
+    print("%-16s %12s %12s" % ("class", "__dict__", "__slots__"))
+    for cls, build in _SAMPLE_OBJECTS:
+        after = _bytes_per_object(cls, build, count)
+        if hasattr(cls, "__slots__"):
+            before = "%12.1f" % _bytes_per_object(_dict_class(cls), build, count)
+        else:
+            before = "%12s" % "-"
+        print("%-16s %s %12.1f" % (cls.__name__, before, after))
+
+def _best_time(f, repeat=5):
+    """Best wall clock time of repeat calls to f, in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+def bench_shortids(count=5000):
+    """BIP 152 shortids for a block of count transactions."""
+    block = CBlock()
+    for i in range(count):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(random.getrandbits(256), 0), b"\x51"))
+        tx.vout.append(CTxOut(i, b"\x51"))
+        tx.rehash()
+        block.vtx.append(tx)
+    block.rehash()
+    k0, k1 = HeaderAndShortIDs().get_siphash_keys()
+    tx_hashes = [tx.sha256 for tx in block.vtx]
+
+    print("%-36s %8.1f ms" % ("calculate_shortid per tx",
+          _best_time(lambda: [calculate_shortid(k0, k1, h) for h in tx_hashes])))
+    print("%-36s %8.1f ms" % ("siphash256_many, pure Python",
+          _best_time(lambda: siphash.siphash256_many(k0, k1, tx_hashes, use_numpy=False))))
+    if siphash.numpy is not None:
+        print("%-36s %8.1f ms" % ("siphash256_many, NumPy",
+              _best_time(lambda: siphash.siphash256_many(k0, k1, tx_hashes, use_numpy=True))))
+    else:
+        print("siphash256_many, NumPy: not installed")
+    print("%-36s %8.1f ms" % ("HeaderAndShortIDs.initialize_from_block",
+          _best_time(lambda: HeaderAndShortIDs().initialize_from_block(block))))
+
+def _frame(message):
+    data = message.serialize()
+    return (NodeConn.MAGIC_BYTES["regtest"] + message.command.ljust(12, b"\x00") +
+            struct.pack("<I", len(data)) + hash256(data)[:4] + data)
+
+def _serve_blocks(blocks):
+    """Listen on a loopback port and answer every connection like a peer that
+    completes the handshake and then relays blocks, followed by a pong, each
+    time it is pinged.  Returns the port."""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+
+    def serve(conn):
+        buf = b""
+        while True:
+            data = conn.recv(1 << 16)
+            if not data:
+                return
+            buf += data
+            while len(buf) >= 24 and len(buf) >= 24 + struct.unpack("<I", buf[16:20])[0]:
+                command = buf[4:16].rstrip(b"\x00")
+                end = 24 + struct.unpack("<I", buf[16:20])[0]
+                payload, buf = buf[24:end], buf[end:]
+                if command == b"version":
+                    conn.sendall(_frame(msg_version()) + _frame(msg_verack()))
+                elif command == b"ping":
+                    conn.sendall(blocks + _frame(msg_pong(struct.unpack("<Q", payload)[0])))
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+class _BlockCounter(SingleNodeConnCB):
+    def __init__(self, decode):
+        super().__init__()
+        self.decode = decode
+        self.blocks = 0
+
+    def on_block(self, conn, message):
+        if self.decode:
+            message.block
+        self.blocks += 1
+
+@contextmanager
+def _framework_logging():
+    """Log everything at DEBUG to a temporary file, as TestFramework does."""
+    log = logging.getLogger("TestFramework")
+    level = log.level
+    fd, logfile = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    handler = logging.FileHandler(logfile)
+    handler.setLevel(logging.DEBUG)
+    log.setLevel(logging.DEBUG)
+    log.addHandler(handler)
+    try:
+        yield
+    finally:
+        log.removeHandler(handler)
+        log.setLevel(level)
+        handler.close()
+        os.remove(logfile)
+
+def bench_block_relay(count=50, txs=1000):
+    """Receiving count ~1MB blocks from a loopback peer, per checksum mode,
+    with TestFramework's logging."""
+    block = CBlock()
+    for i in range(txs):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(random.getrandbits(256), 0), b"\x51" * 100))
+        tx.vout.append(CTxOut(i, b"\x51" * 900))
+        block.vtx.append(tx)
+    blocks = _frame(msg_block(block)) * count
+    port = _serve_blocks(blocks)
+
+    print("%-8s %-9s %8s %10s" % ("checks", "handler", "time", "MB/s"))
+    with _framework_logging():
+        for decode in (False, True):
+            for mode in CHECKSUM_MODES:
+                cb = _BlockCounter(decode)
+                conn = NodeConn("127.0.0.1", port, None, cb, checksums=mode)
+                cb.add_connection(conn)
+                thread = NetworkThread()
+                thread.start()
+                cb.wait_for_verack()
+                start = time.time()
+                cb.sync_with_ping(timeout=600)
+                elapsed = time.time() - start
+                assert cb.blocks == count
+                conn.disconnect_node()
+                thread.join()
+                print("%-8s %-9s %7.3fs %10.1f" % (mode, "decodes" if decode else "ignores",
+                      elapsed, len(blocks) / elapsed / 1e6))
+
+BENCHMARKS = {
+    "block_relay": bench_block_relay,
+    "shortids": bench_shortids,
+    "slots_memory": bench_slots_memory,
+}
+
+def main(args):
+    names = args or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit("Unknown benchmark %s (available: %s)" % (name, ", ".join(sorted(BENCHMARKS))))
+    for name in names:
+        print("== %s" % name)
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,6 +4,8 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Utilities for manipulating blocks and transactions."""
 
+import os
+
 from .mininode import *
 from .script import CScript, OP_TRUE, OP_CHECKSIG, OP_RETURN
 
@@ -103,3 +105,93 @@ def get_legacy_sigopcount_tx(tx, fAccurate=True):
         # scriptSig might be of type bytes, so convert to CScript for the moment
         count += CScript(j.scriptSig).GetSigOpCount(fAccurate)
     return count
+
+# Regtest genesis block
+REGTEST_GENESIS_HASH = 0x0f9188f13cb7b2c71f2a335e3a4fc328bf5beb436012afca590b1a11466e2206
+REGTEST_GENESIS_TIME = 1296688602
+
+COINBASE_MATURITY = 100
+# Largest blk?????.dat file bitcoind writes (MAX_BLOCKFILE_SIZE)
+MAX_BLOCKFILE_SIZE = 0x8000000
+
+class ChainBuilder(object):
+    """Build a chain of solved regtest blocks without a running node.
+
+    Blocks are created with create_block/create_coinbase on top of tip (the
+    regtest genesis block by default), spaced `spacing` seconds apart unless
+    an explicit nTime is given.  write_block_files() stores them in the
+    blk?????.dat format, so a node can import them with -loadblock=<file> (see
+    util.start_node_from_block_files), or with -reindex once the files are
+    copied into its blocks directory.
+
+    Version 4 is used by default since BIP65 and BIP66 are active from
+    heights 1351 and 1251 on regtest.
+    """
+    def __init__(self, tip=REGTEST_GENESIS_HASH, height=0, start_time=REGTEST_GENESIS_TIME,
+                 spacing=600, coinbase_pubkey=None, version=4):
+        self.tip = tip
+        self.height = height
+        self.start_height = height
+        self.block_time = start_time
+        self.spacing = spacing
+        self.coinbase_pubkey = coinbase_pubkey
+        self.version = version
+        self.blocks = []
+
+    def add_block(self, txs=None, nTime=None, coinbase_pubkey=None):
+        """Append a block with the given extra transactions and return it."""
+        height = self.height + 1
+        if nTime is None:
+            nTime = self.block_time + self.spacing
+        if coinbase_pubkey is None:
+            coinbase_pubkey = self.coinbase_pubkey
+        block = create_block(self.tip, create_coinbase(height, coinbase_pubkey), nTime)
+        block.nVersion = self.version
+        if txs:
+            block.vtx.extend(txs)
+            block.hashMerkleRoot = block.calc_merkle_root()
+        block.solve()
+        self.blocks.append(block)
+        self.tip = block.sha256
+        self.height = height
+        self.block_time = nTime
+        return block
+
+    def add_blocks(self, count, **kwargs):
+        return [self.add_block(**kwargs) for _ in range(count)]
+
+    def get_spendable_coinbases(self):
+        """Coinbase transactions that can be spent in the next block."""
+        mature = self.height + 1 - COINBASE_MATURITY - self.start_height
+        return [block.vtx[0] for block in self.blocks[:max(mature, 0)]]
+
+    def write_block_files(self, dirname, max_file_size=MAX_BLOCKFILE_SIZE):
+        """Write the blocks to dirname/blk00000.dat, blk00001.dat, ...
+
+        A list of the block hashes, one per line, is written to
+        dirname/hashlist.txt.  Returns the paths of the block files.
+        """
+        os.makedirs(dirname, exist_ok=True)
+        magic = NodeConn.MAGIC_BYTES["regtest"]
+        paths = []
+        data = bytearray()
+        for block in self.blocks:
+            serialized = block.serialize()
+            if data and len(data) + 8 + len(serialized) > max_file_size:
+                paths.append(_write_block_file(dirname, len(paths), data))
+                data = bytearray()
+            data += magic
+            data += struct.pack("<I", len(serialized))
+            data += serialized
+        if data:
+            paths.append(_write_block_file(dirname, len(paths), data))
+        with open(os.path.join(dirname, "hashlist.txt"), "w", encoding="utf8") as f:
+            for block in self.blocks:
+                f.write(block.hash + "\n")
+        return paths
+
+def _write_block_file(dirname, n, data):
+    path = os.path.join(dirname, "blk%05d.dat" % n)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Content-addressed cache of pregenerated datadirs.
+
+Every cache entry is a set of node datadirs built by one of the VARIANTS.
+Entries live in cachedir/<variant>-<key>/, where the key is a hash of the
+bitcoind binary, the variant's chain generation parameters and the number of
+nodes, so a rebuilt bitcoind or a changed parameter gets a fresh entry instead
+of silently reusing a stale one.  Entries are built in a temporary directory
+and renamed into place once complete, so concurrent tests never see a partial
+entry.
+
+Tests get private copies of an entry through util.provision_datadir.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from .util import (
+    MAX_NODES,
+    bitcoind_processes,
+    disable_mocktime,
+    enable_mocktime,
+    get_mocktime,
+    get_rpc_proxy,
+    initialize_datadir,
+    kill_nodes,
+    log_filename,
+    log_offset,
+    p2p_port,
+    provision_datadir,
+    rpc_url,
+    set_node_times,
+    stop_nodes,
+    sync_blocks,
+    sync_mempools,
+    wait_for_bitcoind_start,
+)
+
+logger = logging.getLogger("TestFramework.chaincache")
+
+# Bump when the way entries are built changes, to invalidate old entries
+CACHE_FORMAT_VERSION = 1
+# Marker written once an entry is complete
+CACHE_INFO_FILE = "cache.json"
+
+# Chain generation parameters of each variant:
+#   height: length of the chain.  Blocks are mined in batches of 25 by the
+#           first `miners` nodes in turn, so the first 200 blocks give each
+#           of 4 miners 25 mature and 25 immature coinbases.
+#   miners: number of nodes that mine.
+#   mempool_txs: number of wallet transactions left unconfirmed in the
+#                mempools (and persisted in mempool.dat) at shutdown.
+VARIANTS = {
+    "clean": {"height": 0, "miners": 4, "mempool_txs": 0},
+    "200-block": {"height": 200, "miners": 4, "mempool_txs": 0},
+    # BIP9 on regtest: started at 144, locked in at 288, active at 432
+    "segwit-active": {"height": 432, "miners": 4, "mempool_txs": 0},
+    "large-mempool": {"height": 200, "miners": 4, "mempool_txs": 100},
+}
+
+BLOCKS_PER_BATCH = 25
+
+_binary_digests = {}
+
+def binary_digest(binary):
+    """Return the sha256 of a bitcoind binary, or of its name if it can't be found."""
+    path = shutil.which(binary) or binary
+    try:
+        st = os.stat(path)
+    except OSError:
+        return hashlib.sha256(binary.encode('utf8')).hexdigest()
+    path = os.path.realpath(path)
+    stamp = (path, st.st_size, st.st_mtime_ns)
+    if stamp not in _binary_digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _binary_digests[stamp] = h.hexdigest()
+    return _binary_digests[stamp]
+
+def _build_chain(dirname, binary, num_nodes, height, miners, mempool_txs):
+    """Start num_nodes bitcoinds in dirname and generate the chain."""
+    logs = []
+    for i in range(num_nodes):
+        datadir = initialize_datadir(dirname, i)
+        args = [ binary, "-server", "-keypool=1", "-datadir="+datadir, "-discover=0" ]
+        if i > 0:
+            args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
+        debug_log = log_filename(dirname, i, "debug.log")
+        logs.append((debug_log, log_offset(debug_log)))
+        bitcoind_processes[i] = subprocess.Popen(args)
+        logger.debug("_build_chain: bitcoind started")
+    try:
+        for i in range(num_nodes):
+            wait_for_bitcoind_start(bitcoind_processes[i], rpc_url(i), i, *logs[i])
+    except:
+        kill_nodes(range(num_nodes))
+        raise
+    logger.debug("_build_chain: RPC successfully started")
+    rpcs = [get_rpc_proxy(rpc_url(i), i) for i in range(num_nodes)]
+
+    # Blocks are created with timestamps 10 minutes apart, ending one block
+    # interval before the mocktime the cached chain is used with.
+    enable_mocktime()
+    try:
+        block_time = get_mocktime() - ((height + 1) * 10 * 60)
+        batch = 0
+        while batch * BLOCKS_PER_BATCH < height:
+            peer = batch % miners
+            for j in range(min(BLOCKS_PER_BATCH, height - batch * BLOCKS_PER_BATCH)):
+                set_node_times(rpcs, block_time)
+                rpcs[peer].generate(1)
+                block_time += 10*60
+            # Must sync before next peer starts generating blocks
+            sync_blocks(rpcs)
+            batch += 1
+
+        if mempool_txs:
+            set_node_times(rpcs, get_mocktime())
+            for i in range(mempool_txs):
+                peer = i % miners
+                rpcs[peer].sendtoaddress(rpcs[peer].getnewaddress(), 1)
+            sync_mempools(rpcs)
+    finally:
+        stop_nodes(rpcs)
+        disable_mocktime()
+
+    for i in range(num_nodes):
+        for f in ("debug.log", "db.log", "peers.dat", "fee_estimates.dat"):
+            path = log_filename(dirname, i, f)
+            if os.path.exists(path):
+                os.remove(path)
+
+class DatadirCache(object):
+    """Pregenerated datadirs under cachedir, keyed by binary, variant and node count."""
+
+    def __init__(self, cachedir, binary=None):
+        self.cachedir = cachedir
+        self.binary = binary or os.getenv("BITCOIND", "bitcoind")
+
+    def get_params(self, variant, **params):
+        if variant not in VARIANTS:
+            raise ValueError("Unknown datadir cache variant %s (available: %s)" %
+                             (variant, ", ".join(sorted(VARIANTS))))
+        merged = dict(VARIANTS[variant])
+        for name, value in params.items():
+            if name not in merged:
+                raise ValueError("Unknown parameter %s for datadir cache variant %s" % (name, variant))
+            merged[name] = value
+        return merged
+
+    def get_key(self, variant, num_nodes, **params):
+        """Return the key of the entry for a test that needs num_nodes, as a dict.
+
+        Every entry holds MAX_NODES nodes (or every miner, if there are more),
+        so that all tests of a variant share one entry and see the same coin
+        distribution, whatever num_nodes they need.
+        """
+        params = self.get_params(variant, **params)
+        return {
+            "version": CACHE_FORMAT_VERSION,
+            "binary": binary_digest(self.binary),
+            "variant": variant,
+            "params": params,
+            "num_nodes": max(MAX_NODES, params["miners"]),
+        }
+
+    def get_entry_dir(self, key):
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf8')).hexdigest()
+        return os.path.join(self.cachedir, "%s-%s" % (key["variant"], digest[:16]))
+
+    def get(self, variant, num_nodes, **params):
+        """Return the directory of a complete entry, building it if needed."""
+        assert num_nodes <= MAX_NODES
+        key = self.get_key(variant, num_nodes, **params)
+        entry_dir = self.get_entry_dir(key)
+        if os.path.isfile(os.path.join(entry_dir, CACHE_INFO_FILE)):
+            return entry_dir
+
+        logger.debug("Creating %s datadir cache in %s" % (variant, entry_dir))
+        os.makedirs(self.cachedir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=".build-", dir=self.cachedir)
+        try:
+            _build_chain(build_dir, self.binary, key["num_nodes"], **key["params"])
+            with open(os.path.join(build_dir, CACHE_INFO_FILE), 'w', encoding='utf8') as f:
+                json.dump(key, f, sort_keys=True, indent=1)
+            try:
+                os.rename(build_dir, entry_dir)
+            except OSError:
+                # Another process completed the same entry first
+                if not os.path.isfile(os.path.join(entry_dir, CACHE_INFO_FILE)):
+                    raise
+        finally:
+            if os.path.isdir(build_dir):
+                shutil.rmtree(build_dir)
+        return entry_dir
+
+    def provision(self, test_dir, num_nodes, variant="200-block", **params):
+        """Create datadirs for nodes 0..num_nodes-1 in test_dir from the cache."""
+        entry_dir = self.get(variant, num_nodes, **params)
+        total = {"reflink": 0, "hardlink": 0, "copy": 0, "bytes": 0, "time": 0}
+        for i in range(num_nodes):
+            stats = provision_datadir(os.path.join(entry_dir, "node"+str(i)),
+                                      os.path.join(test_dir, "node"+str(i)))
+            for k in total:
+                total[k] += stats[k]
+            initialize_datadir(test_dir, i) # Overwrite port/rpcport in bitcoin.conf
+        logger.info("Provisioned %d %s datadirs in %.3fs (%d reflinked, %d hardlinked, %d copied, %.1f MB)" %
+                    (num_nodes, variant, total["time"], total["reflink"], total["hardlink"],
+                     total["copy"], total["bytes"] / 1e6))
+        return total
@@ -41,8 +41,8 @@ class RejectResult(object):
 
 class TestNode(NodeConnCB):
 
-    def __init__(self, block_store, tx_store):
-        NodeConnCB.__init__(self)
+    def __init__(self, block_store, tx_store, delivery_queue):
+        NodeConnCB.__init__(self, delivery_queue)
         self.conn = None
         self.bestblockhash = None
         self.block_store = block_store
@@ -170,12 +170,14 @@ class TestManager(object):
         self.test_nodes     = []
         self.block_store    = BlockStore(datadir)
         self.tx_store       = TxStore(datadir)
+        # The TestNodes share the stores, so deliver to them one at a time
+        self.delivery_queue = DeliveryQueue()
         self.ping_counter   = 1
 
     def add_all_connections(self, nodes):
         for i in range(len(nodes)):
             # Create a p2p connection to each node
-            test_node = TestNode(self.block_store, self.tx_store)
+            test_node = TestNode(self.block_store, self.tx_store, self.delivery_queue)
             self.test_nodes.append(test_node)
             self.connections.append(NodeConn('127.0.0.1', p2p_port(i), nodes[i], test_node))
             # Make sure the TestNode (callback class) has a reference to its
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Pure-Python secp256k1 arithmetic and ECDSA.
+
+Used by key.py when OpenSSL can't be loaded.  Points are kept in Jacobian
+coordinates (X, Y, Z), representing the affine point (X/Z^2, Y/Z^3), so that
+no modular inversion is needed until the end of a multiplication.  None is
+the point at infinity.  Multiples of G are looked up in tables built on first
+use, and nonces are derived deterministically as in RFC 6979.
+
+This is test code: it is not constant time and must not be used for real keys.
+"""
+
+import hashlib
+import hmac
+
+# Field size and group order
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+# y^2 = x^3 + 7
+B = 7
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+try:
+    pow(2, -1, 3)
+    def modinv(a, m):
+        return pow(a, -1, m)
+except ValueError:
+    # Python < 3.8 has no modular inverse in pow(); m is always prime here.
+    def modinv(a, m):
+        return pow(a, m - 2, m)
+
+def jacobian_double(p):
+    if p is None:
+        return None
+    x, y, z = p
+    if y == 0:
+        return None
+    yy = y * y % P
+    s = 4 * x * yy % P
+    m = 3 * x * x % P
+    x3 = (m * m - 2 * s) % P
+    y3 = (m * (s - x3) - 8 * yy * yy) % P
+    z3 = 2 * y * z % P
+    return (x3, y3, z3)
+
+def jacobian_add_affine(p, q):
+    """Add Jacobian point p and affine point q."""
+    if p is None:
+        return (q[0], q[1], 1)
+    x1, y1, z1 = p
+    x2, y2 = q
+    z1z1 = z1 * z1 % P
+    h = (x2 * z1z1 - x1) % P
+    r = (y2 * z1 * z1z1 - y1) % P
+    if h == 0:
+        if r == 0:
+            return jacobian_double(p)
+        return None
+    hh = h * h % P
+    hhh = h * hh % P
+    v = x1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - y1 * hhh) % P
+    z3 = z1 * h % P
+    return (x3, y3, z3)
+
+def jacobian_add(p, q):
+    if p is None:
+        return q
+    if q is None:
+        return p
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+    z1z1 = z1 * z1 % P
+    z2z2 = z2 * z2 % P
+    u1 = x1 * z2z2 % P
+    u2 = x2 * z1z1 % P
+    s1 = y1 * z2 * z2z2 % P
+    s2 = y2 * z1 * z1z1 % P
+    h = (u2 - u1) % P
+    r = (s2 - s1) % P
+    if h == 0:
+        if r == 0:
+            return jacobian_double(p)
+        return None
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - s1 * hhh) % P
+    z3 = z1 * z2 * h % P
+    return (x3, y3, z3)
+
+def to_affine(p):
+    if p is None:
+        return None
+    x, y, z = p
+    zinv = modinv(z, P)
+    zinv2 = zinv * zinv % P
+    return (x * zinv2 % P, y * zinv2 * zinv % P)
+
+# k*G is computed from per-window tables: _G_TABLE[i][d - 1] is the affine
+# point d * 2^(i * G_WINDOW) * G, so a multiplication is one mixed addition
+# per non-zero window and no doublings.
+G_WINDOW = 6
+_G_TABLE = None
+
+def _build_g_table():
+    table = []
+    base = (G[0], G[1], 1)
+    for i in range(-(-256 // G_WINDOW)):
+        row = []
+        p = base
+        for d in range(1, 1 << G_WINDOW):
+            row.append(p)
+            p = jacobian_add(p, base)
+        base = p
+        table.append([to_affine(q) for q in row])
+    return table
+
+def point_mul_g(k):
+    global _G_TABLE
+    if _G_TABLE is None:
+        _G_TABLE = _build_g_table()
+    mask = (1 << G_WINDOW) - 1
+    result = None
+    for row in _G_TABLE:
+        d = k & mask
+        if d:
+            result = jacobian_add_affine(result, row[d - 1])
+        k >>= G_WINDOW
+        if not k:
+            break
+    return result
+
+def point_mul(p, k):
+    """Multiply affine point p by k, using a 4-bit fixed window."""
+    multiples = [p]
+    q = (p[0], p[1], 1)
+    for i in range(2, 16):
+        q = jacobian_add_affine(q, p)
+        multiples.append(to_affine(q))
+    result = None
+    for shift in range((k.bit_length() + 3) // 4 * 4 - 4, -4, -4):
+        for _ in range(4):
+            result = jacobian_double(result)
+        d = (k >> shift) & 0xf
+        if d:
+            result = jacobian_add_affine(result, multiples[d - 1])
+    return result
+
+def is_on_curve(p):
+    x, y = p
+    return 0 <= x < P and 0 <= y < P and (y * y - x * x * x - B) % P == 0
+
+def encode_point(p, compressed):
+    x, y = p
+    if compressed:
+        return bytes([2 + (y & 1)]) + x.to_bytes(32, 'big')
+    return b'\x04' + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+
+def decode_point(data):
+    """Parse an encoded public key; returns (point, compressed) or None."""
+    if len(data) == 33 and data[0] in (2, 3):
+        x = int.from_bytes(data[1:], 'big')
+        if x >= P:
+            return None
+        y2 = (x * x * x + B) % P
+        y = pow(y2, (P + 1) // 4, P)
+        if y * y % P != y2:
+            return None
+        if (y & 1) != (data[0] & 1):
+            y = P - y
+        return ((x, y), True)
+    if len(data) == 65 and data[0] in (4, 6, 7):
+        p = (int.from_bytes(data[1:33], 'big'), int.from_bytes(data[33:], 'big'))
+        if not is_on_curve(p):
+            return None
+        # Hybrid encodings (6 and 7) also carry the parity of y
+        if data[0] != 4 and (p[1] & 1) != (data[0] & 1):
+            return None
+        return (p, False)
+    return None
+
+def hash_to_int(h):
+    z = int.from_bytes(h, 'big')
+    excess = len(h) * 8 - 256
+    if excess > 0:
+        z >>= excess
+    return z
+
+def rfc6979_nonces(secret, h):
+    """Generate the RFC 6979 (HMAC-SHA256) nonces for signing h with secret."""
+    x = secret.to_bytes(32, 'big')
+    h1 = (hash_to_int(h) % N).to_bytes(32, 'big')
+    k = b'\x00' * 32
+    v = b'\x01' * 32
+    k = hmac.new(k, v + b'\x00' + x + h1, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    k = hmac.new(k, v + b'\x01' + x + h1, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    while True:
+        v = hmac.new(k, v, hashlib.sha256).digest()
+        nonce = int.from_bytes(v, 'big')
+        if 1 <= nonce < N:
+            yield nonce
+        k = hmac.new(k, v + b'\x00', hashlib.sha256).digest()
+        v = hmac.new(k, v, hashlib.sha256).digest()
+
+def ecdsa_sign(secret, h):
+    """Sign hash h; returns (r, s)."""
+    z = hash_to_int(h)
+    for nonce in rfc6979_nonces(secret, h):
+        r = to_affine(point_mul_g(nonce))[0] % N
+        if r == 0:
+            continue
+        s = modinv(nonce, N) * (z + r * secret) % N
+        if s != 0:
+            return (r, s)
+
+def ecdsa_verify(pubkey, h, r, s):
+    if not (1 <= r < N and 1 <= s < N):
+        return False
+    w = modinv(s, N)
+    z = hash_to_int(h)
+    p = jacobian_add(point_mul_g(z * w % N), point_mul(pubkey, r * w % N))
+    if p is None:
+        return False
+    return to_affine(p)[0] % N == r
+
+def der_encode_sig(r, s):
+    rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
+    sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
+    body = b'\x02' + bytes([len(rb)]) + rb + b'\x02' + bytes([len(sb)]) + sb
+    return b'\x30' + bytes([len(body)]) + body
+
+def der_decode_sig(sig):
+    """Parse a strict DER signature; returns (r, s) or None."""
+    if len(sig) < 8 or sig[0] != 0x30 or sig[1] != len(sig) - 2:
+        return None
+    values = []
+    pos = 2
+    for _ in range(2):
+        if pos + 2 > len(sig) or sig[pos] != 0x02:
+            return None
+        size = sig[pos + 1]
+        data = sig[pos + 2:pos + 2 + size]
+        if size == 0 or len(data) != size or data[0] & 0x80:
+            return None
+        if size > 1 and data[0] == 0 and not data[1] & 0x80:
+            return None
+        values.append(int.from_bytes(data, 'big'))
+        pos += 2 + size
+    if pos != len(sig):
+        return None
+    return tuple(values)
@@ -1,117 +1,249 @@
 # Copyright (c) 2011 Sam Rushing
 """ECC secp256k1 OpenSSL wrapper.
 
+If OpenSSL can't be loaded, CECKey falls back to a pure-Python
+implementation (see ecc.py) with the same interface.
+
 WARNING: This module does not mlock() secrets; your private keys may end up on
 disk in swap! Use with caution!
 
 This file is modified from python-bitcoinlib.
 """
 
+from concurrent.futures import ProcessPoolExecutor
 import ctypes
 import ctypes.util
 import hashlib
 import sys
 
-ssl = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
+from . import ecc
 
-ssl.BN_new.restype = ctypes.c_void_p
-ssl.BN_new.argtypes = []
+# this specifies the curve used with ECDSA.
+NID_secp256k1 = 714 # from openssl/obj_mac.h
 
-ssl.BN_bin2bn.restype = ctypes.c_void_p
-ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
-ssl.BN_CTX_free.restype = None
-ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
+# Thx to Sam Devlin for the ctypes magic 64-bit fix.
+def _check_result(val, func, args):
+    if val == 0:
+        raise ValueError
+    else:
+        return ctypes.c_void_p (val)
 
-ssl.BN_CTX_new.restype = ctypes.c_void_p
-ssl.BN_CTX_new.argtypes = []
+def _load_openssl():
+    """Load libssl and declare the functions used here.
 
-ssl.ECDH_compute_key.restype = ctypes.c_int
-ssl.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+    Returns None if the library or any of those functions is unavailable.
+    """
+    try:
+        ssl = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
 
-ssl.ECDSA_sign.restype = ctypes.c_int
-ssl.ECDSA_sign.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        ssl.BN_new.restype = ctypes.c_void_p
+        ssl.BN_new.argtypes = []
 
-ssl.ECDSA_verify.restype = ctypes.c_int
-ssl.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+        ssl.BN_bin2bn.restype = ctypes.c_void_p
+        ssl.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.EC_KEY_free.restype = None
-ssl.EC_KEY_free.argtypes = [ctypes.c_void_p]
+        ssl.BN_bn2bin.restype = ctypes.c_int
+        ssl.BN_bn2bin.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
 
-ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_KEY_new_by_curve_name.argtypes = [ctypes.c_int]
+        ssl.BN_num_bits.restype = ctypes.c_int
+        ssl.BN_num_bits.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_get0_group.restype = ctypes.c_void_p
-ssl.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
+        ssl.BN_free.restype = None
+        ssl.BN_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_get0_public_key.restype = ctypes.c_void_p
-ssl.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
+        ssl.BN_CTX_free.restype = None
+        ssl.BN_CTX_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_KEY_set_private_key.restype = ctypes.c_int
-ssl.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        ssl.BN_CTX_new.restype = ctypes.c_void_p
+        ssl.BN_CTX_new.argtypes = []
 
-ssl.EC_KEY_set_conv_form.restype = None
-ssl.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        ssl.ECDH_compute_key.restype = ctypes.c_int
+        ssl.ECDH_compute_key.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_set_public_key.restype = ctypes.c_int
-ssl.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        ssl.ECDSA_sign.restype = ctypes.c_int
+        ssl.ECDSA_sign.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.i2o_ECPublicKey.restype = ctypes.c_void_p
-ssl.i2o_ECPublicKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        ssl.ECDSA_verify.restype = ctypes.c_int
+        ssl.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
 
-ssl.EC_POINT_new.restype = ctypes.c_void_p
-ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
+        ssl.EC_KEY_free.restype = None
+        ssl.EC_KEY_free.argtypes = [ctypes.c_void_p]
 
-ssl.EC_POINT_free.restype = None
-ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
+        ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
+        ssl.EC_KEY_new_by_curve_name.argtypes = [ctypes.c_int]
 
-ssl.EC_POINT_mul.restype = ctypes.c_int
-ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        ssl.EC_KEY_get0_group.restype = ctypes.c_void_p
+        ssl.EC_KEY_get0_group.argtypes = [ctypes.c_void_p]
 
-# this specifies the curve used with ECDSA.
-NID_secp256k1 = 714 # from openssl/obj_mac.h
+        ssl.EC_KEY_get0_public_key.restype = ctypes.c_void_p
+        ssl.EC_KEY_get0_public_key.argtypes = [ctypes.c_void_p]
 
-SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
-SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+        ssl.EC_KEY_get0_private_key.restype = ctypes.c_void_p
+        ssl.EC_KEY_get0_private_key.argtypes = [ctypes.c_void_p]
 
-# Thx to Sam Devlin for the ctypes magic 64-bit fix.
-def _check_result(val, func, args):
-    if val == 0:
-        raise ValueError
-    else:
-        return ctypes.c_void_p (val)
+        ssl.EC_KEY_set_private_key.restype = ctypes.c_int
+        ssl.EC_KEY_set_private_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
 
-ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
-ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
+        ssl.EC_KEY_set_conv_form.restype = None
+        ssl.EC_KEY_set_conv_form.argtypes = [ctypes.c_void_p, ctypes.c_int]
 
-class CECKey(object):
-    """Wrapper around OpenSSL's EC_KEY"""
+        ssl.EC_KEY_set_public_key.restype = ctypes.c_int
+        ssl.EC_KEY_set_public_key.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+
+        ssl.i2o_ECPublicKey.restype = ctypes.c_void_p
+        ssl.i2o_ECPublicKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+
+        ssl.EC_POINT_new.restype = ctypes.c_void_p
+        ssl.EC_POINT_new.argtypes = [ctypes.c_void_p]
+
+        ssl.EC_POINT_free.restype = None
+        ssl.EC_POINT_free.argtypes = [ctypes.c_void_p]
+
+        ssl.EC_POINT_mul.restype = ctypes.c_int
+        ssl.EC_POINT_mul.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+
+        ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
+        ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
+
+        for name in ('ECDSA_size', 'd2i_ECPrivateKey', 'i2d_ECPrivateKey', 'o2i_ECPublicKey'):
+            getattr(ssl, name)
+    except (OSError, AttributeError):
+        return None
+    return ssl
+
+ssl = _load_openssl()
+
+def _low_s_der(sig):
+    """Return DER signature sig with its S value in the lower half of the order."""
+    assert sig[0] == 0x30
+    assert sig[1] == len(sig) - 2
+    total_size = sig[1]
+    assert sig[2] == 2
+    r_size = sig[3]
+    assert sig[4 + r_size] == 2
+    s_size = sig[5 + r_size]
+    s_value = int.from_bytes(sig[6+r_size:6+r_size+s_size], byteorder='big')
+    if s_value <= SECP256K1_ORDER_HALF:
+        return sig
+    low_s_value = SECP256K1_ORDER - s_value
+    low_s_bytes = (low_s_value).to_bytes(33, byteorder='big')
+    while len(low_s_bytes) > 1 and low_s_bytes[0] == 0 and low_s_bytes[1] < 0x80:
+        low_s_bytes = low_s_bytes[1:]
+    new_s_size = len(low_s_bytes)
+    new_total_size_byte = (total_size + new_s_size - s_size).to_bytes(1,byteorder='big')
+    new_s_size_byte = (new_s_size).to_bytes(1,byteorder='big')
+    return b'\x30' + new_total_size_byte + sig[2:5+r_size] + new_s_size_byte + low_s_bytes
+
+def _chunks(items, n):
+    """Split items into n contiguous, roughly equal lists."""
+    items = list(items)
+    size = -(-len(items) // n)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# Workers for the ProcessPoolExecutor fan-out in sign_many/verify_many.  EC_KEYs
+# can't be pickled, so each chunk rebuilds the key from its secret or pubkey.
+def _sign_chunk(cls, secret, hashes, low_s):
+    key = cls()
+    key.set_secretbytes(secret)
+    return key.sign_many(hashes, low_s)
+
+def _verify_chunk(cls, pubkey, items):
+    key = cls()
+    key.set_pubkey(pubkey)
+    return key.verify_many(items)
+
+class _CECKeyBase(object):
+    """Methods shared by the OpenSSL and pure-Python keys"""
 
     POINT_CONVERSION_COMPRESSED = 2
     POINT_CONVERSION_UNCOMPRESSED = 4
 
+    def get_ecdh_key(self, other_pubkey, kdf=lambda k: hashlib.sha256(k).digest()):
+        # FIXME: be warned it's not clear what the kdf should be as a default
+        r = self.get_raw_ecdh_key(other_pubkey)
+        return kdf(r)
+
+    def _check_hash(self, hash):
+        if not isinstance(hash, bytes):
+            raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
+        if len(hash) != 32:
+            raise ValueError('Hash must be exactly 32 bytes long')
+
+    def sign_many(self, hashes, low_s = True, processes = None):
+        """Sign each of hashes, returning the signatures in the same order.
+
+        If processes is more than one, the hashes are split between that many
+        worker processes.  Starting them costs tens of milliseconds, so this
+        only pays off for batches of thousands of hashes.
+        """
+        hashes = list(hashes)
+        if processes is not None and processes > 1 and len(hashes) > processes:
+            chunks = _chunks(hashes, processes)
+            n = len(chunks)
+            with ProcessPoolExecutor(processes) as executor:
+                results = executor.map(_sign_chunk, [type(self)] * n, [self.get_secretbytes()] * n, chunks, [low_s] * n)
+                return [sig for sigs in results for sig in sigs]
+        return [self.sign(hash, low_s) for hash in hashes]
+
+    def verify_many(self, items, processes = None):
+        """Verify (hash, sig) pairs, returning a list of booleans.
+
+        processes works as in sign_many.
+        """
+        items = list(items)
+        if processes is not None and processes > 1 and len(items) > processes:
+            chunks = _chunks(items, processes)
+            n = len(chunks)
+            with ProcessPoolExecutor(processes) as executor:
+                results = executor.map(_verify_chunk, [type(self)] * n, [self.get_pubkey()] * n, chunks)
+                return [ok for oks in results for ok in oks]
+        return [self.verify(hash, sig) for hash, sig in items]
+
+class OpenSSLECKey(_CECKeyBase):
+    """Wrapper around OpenSSL's EC_KEY"""
+
     def __init__(self):
+        # Set first, so __del__ works even if __init__ fails part way
+        self.k = None
+        self.ctx = None
         self.k = ssl.EC_KEY_new_by_curve_name(NID_secp256k1)
+        # Allocated once and reused by every set_secretbytes()/sign() call
+        self.ctx = ssl.BN_CTX_new()
+        self.sig_size = ctypes.c_uint32()
+        self.mb_sig = ctypes.create_string_buffer(ssl.ECDSA_size(self.k))
 
     def __del__(self):
+        k = getattr(self, 'k', None)
+        ctx = getattr(self, 'ctx', None)
         if ssl:
-            ssl.EC_KEY_free(self.k)
+            if k:
+                ssl.EC_KEY_free(k)
+            if ctx:
+                ssl.BN_CTX_free(ctx)
         self.k = None
+        self.ctx = None
 
     def set_secretbytes(self, secret):
-        priv_key = ssl.BN_bin2bn(secret, 32, ssl.BN_new())
+        priv_key = ssl.BN_bin2bn(secret, len(secret), None)
         group = ssl.EC_KEY_get0_group(self.k)
         pub_key = ssl.EC_POINT_new(group)
-        ctx = ssl.BN_CTX_new()
-        if not ssl.EC_POINT_mul(group, pub_key, priv_key, None, None, ctx):
+        if not ssl.EC_POINT_mul(group, pub_key, priv_key, None, None, self.ctx):
             raise ValueError("Could not derive public key from the supplied secret.")
-        ssl.EC_POINT_mul(group, pub_key, priv_key, None, None, ctx)
         ssl.EC_KEY_set_private_key(self.k, priv_key)
         ssl.EC_KEY_set_public_key(self.k, pub_key)
         ssl.EC_POINT_free(pub_key)
-        ssl.BN_CTX_free(ctx)
+        ssl.BN_free(priv_key)
         return self.k
 
+    def get_secretbytes(self):
+        priv_key = ssl.EC_KEY_get0_private_key(self.k)
+        mb = ctypes.create_string_buffer((ssl.BN_num_bits(priv_key) + 7) // 8)
+        size = ssl.BN_bn2bin(priv_key, mb)
+        return mb.raw[:size].rjust(32, b'\x00')
+
     def set_privkey(self, key):
         self.mb = ctypes.create_string_buffer(key)
         return ssl.d2i_ECPrivateKey(ctypes.byref(self.k), ctypes.byref(ctypes.pointer(self.mb)), len(key))
@@ -141,42 +273,18 @@ class CECKey(object):
             raise Exception('CKey.get_ecdh_key(): ECDH_compute_key() failed')
         return ecdh_keybuffer.raw
 
-    def get_ecdh_key(self, other_pubkey, kdf=lambda k: hashlib.sha256(k).digest()):
-        # FIXME: be warned it's not clear what the kdf should be as a default
-        r = self.get_raw_ecdh_key(other_pubkey)
-        return kdf(r)
-
     def sign(self, hash, low_s = True):
         # FIXME: need unit tests for below cases
-        if not isinstance(hash, bytes):
-            raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
-        if len(hash) != 32:
-            raise ValueError('Hash must be exactly 32 bytes long')
+        self._check_hash(hash)
 
-        sig_size0 = ctypes.c_uint32()
-        sig_size0.value = ssl.ECDSA_size(self.k)
-        mb_sig = ctypes.create_string_buffer(sig_size0.value)
-        result = ssl.ECDSA_sign(0, hash, len(hash), mb_sig, ctypes.byref(sig_size0), self.k)
+        sig_size = self.sig_size
+        sig_size.value = len(self.mb_sig)
+        result = ssl.ECDSA_sign(0, hash, len(hash), self.mb_sig, ctypes.byref(sig_size), self.k)
         assert 1 == result
-        assert mb_sig.raw[0] == 0x30
-        assert mb_sig.raw[1] == sig_size0.value - 2
-        total_size = mb_sig.raw[1]
-        assert mb_sig.raw[2] == 2
-        r_size = mb_sig.raw[3]
-        assert mb_sig.raw[4 + r_size] == 2
-        s_size = mb_sig.raw[5 + r_size]
-        s_value = int.from_bytes(mb_sig.raw[6+r_size:6+r_size+s_size], byteorder='big')
-        if (not low_s) or s_value <= SECP256K1_ORDER_HALF:
-            return mb_sig.raw[:sig_size0.value]
-        else:
-            low_s_value = SECP256K1_ORDER - s_value
-            low_s_bytes = (low_s_value).to_bytes(33, byteorder='big')
-            while len(low_s_bytes) > 1 and low_s_bytes[0] == 0 and low_s_bytes[1] < 0x80:
-                low_s_bytes = low_s_bytes[1:]
-            new_s_size = len(low_s_bytes)
-            new_total_size_byte = (total_size + new_s_size - s_size).to_bytes(1,byteorder='big')
-            new_s_size_byte = (new_s_size).to_bytes(1,byteorder='big')
-            return b'\x30' + new_total_size_byte + mb_sig.raw[2:5+r_size] + new_s_size_byte + low_s_bytes
+        sig = self.mb_sig.raw[:sig_size.value]
+        if low_s:
+            sig = _low_s_der(sig)
+        return sig
 
     def verify(self, hash, sig):
         """Verify a DER signature"""
@@ -190,6 +298,93 @@ class CECKey(object):
         ssl.EC_KEY_set_conv_form(self.k, form)
 
 
+# secp256k1 OID 1.3.132.0.10, as the named-curve parameters of an ECPrivateKey
+_DER_SECP256K1_PARAMS = b'\xa0\x07\x06\x05\x2b\x81\x04\x00\x0a'
+
+def _der_length(n):
+    if n < 0x80:
+        return bytes([n])
+    return b'\x81' + bytes([n])
+
+class PythonECKey(_CECKeyBase):
+    """Pure-Python key with the same interface as OpenSSLECKey
+
+    Signatures use RFC 6979 nonces, so they are deterministic.
+    """
+
+    def __init__(self):
+        self.secret = None
+        self.pubkey = None
+        self.compressed = False
+
+    def set_secretbytes(self, secret):
+        k = int.from_bytes(secret, 'big')
+        if not 0 < k < ecc.N:
+            raise ValueError("Could not derive public key from the supplied secret.")
+        self.secret = k
+        self.pubkey = ecc.to_affine(ecc.point_mul_g(k))
+
+    def get_secretbytes(self):
+        return self.secret.to_bytes(32, 'big')
+
+    def set_privkey(self, key):
+        """Load a DER ECPrivateKey, as written by get_privkey()"""
+        try:
+            pos = 2 if key[1] < 0x80 else 2 + (key[1] & 0x7f)
+            if key[0] != 0x30 or key[pos:pos + 4] != b'\x02\x01\x01\x04':
+                return 0
+            size = key[pos + 4]
+            self.set_secretbytes(key[pos + 5:pos + 5 + size])
+        except (IndexError, ValueError):
+            return 0
+        return 1
+
+    def set_pubkey(self, key):
+        decoded = ecc.decode_point(key)
+        if decoded is None:
+            return 0
+        self.pubkey, self.compressed = decoded
+        return 1
+
+    def get_privkey(self):
+        pubkey = b'\x00' + self.get_pubkey()
+        pubkey = b'\x03' + _der_length(len(pubkey)) + pubkey
+        body = (b'\x02\x01\x01' + b'\x04\x20' + self.get_secretbytes() +
+                _DER_SECP256K1_PARAMS + b'\xa1' + _der_length(len(pubkey)) + pubkey)
+        return b'\x30' + _der_length(len(body)) + body
+
+    def get_pubkey(self):
+        return ecc.encode_point(self.pubkey, self.compressed)
+
+    def get_raw_ecdh_key(self, other_pubkey):
+        p = ecc.point_mul(other_pubkey.pubkey, self.secret)
+        return ecc.to_affine(p)[0].to_bytes(32, 'big')
+
+    def sign(self, hash, low_s = True):
+        self._check_hash(hash)
+        r, s = ecc.ecdsa_sign(self.secret, hash)
+        if low_s and s > SECP256K1_ORDER_HALF:
+            s = SECP256K1_ORDER - s
+        return ecc.der_encode_sig(r, s)
+
+    def verify(self, hash, sig):
+        """Verify a DER signature"""
+        rs = ecc.der_decode_sig(sig)
+        if rs is None or self.pubkey is None:
+            return False
+        return ecc.ecdsa_verify(self.pubkey, hash, rs[0], rs[1])
+
+    def set_compressed(self, compressed):
+        self.compressed = bool(compressed)
+
+# OpenSSL is used when it can be loaded; otherwise the pure-Python
+# implementation takes over.
+if ssl is not None:
+    CECKey = OpenSSLECKey
+else:
+    CECKey = PythonECKey
+
+
 class CPubKey(bytes):
     """An encapsulated public key
 
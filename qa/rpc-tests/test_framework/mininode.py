@@ -22,7 +22,7 @@ ser_*, deser_*: functions that handle serialization/deserialization
 
 import struct
 import socket
-import asyncore
+import asyncio
 import time
 import sys
 import random
@@ -30,11 +30,17 @@ from .util import hex_str_to_bytes, bytes_to_hex_str
 from io import BytesIO
 from codecs import encode
 import hashlib
-from threading import RLock
+import ipaddress
+from threading import Condition, Lock, RLock, get_ident
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
 from threading import Thread
 import logging
 import copy
-from test_framework.siphash import siphash256
+from collections import deque
+from test_framework import siphash
+from test_framework.siphash import siphash256, siphash256_many
 
 BIP0031_VERSION = 60000
 MY_VERSION = 70014  # past bip-31 for ping/pong
@@ -53,18 +59,197 @@ NODE_WITNESS = (1 << 3)
 
 logger = logging.getLogger("TestFramework.mininode")
 
-# Keep our own socket map for asyncore, so that we can track disconnects
-# ourselves (to workaround an issue with closing an asyncore socket when
-# using select)
-mininode_socket_map = dict()
+# All NodeConns run on this event loop, in the NetworkThread.  It runs until
+# the last open connection is closed.
+mininode_loop = asyncio.new_event_loop()
+# Held by the NetworkThread running mininode_loop.  A test may start a new
+# NetworkThread as soon as it sees its last connection close, before the
+# previous thread has returned from run_forever(); the new one waits here.
+mininode_loop_lock = Lock()
+
+# The NodeConns that are connecting or connected
+mininode_connections = set()
+mininode_connections_lock = Lock()
+
+# NodeConn receives straight into its buffer (recv_into) where asyncio
+# supports it, i.e. Python 3.7 and later
+_NodeConnProtocol = getattr(asyncio, "BufferedProtocol", asyncio.Protocol)
+# Initial size of a NodeConn's receive buffer, and the free space it keeps
+# available for each read; it grows when a message doesn't fit.
+RECV_BUFFER_SIZE = 1 << 18
+RECV_READ_SIZE = 1 << 16
+# A NodeConn stops handing queued messages to its transport while the
+# transport buffers more than this, and resumes once it has drained.
+SEND_BUFFER_HIGH_WATER = 1 << 20
+# How a NodeConn checks the checksums of received messages:
+#   "always": every message, as it is framed (the default).
+#   "sample": one message in CHECKSUM_SAMPLE_INTERVAL.
+#   "lazy":   when a message is decoded, so unused payloads are never hashed.
+# Only "always" may be used for peers that aren't on a loopback address.
+CHECKSUM_MODES = ("always", "sample", "lazy")
+CHECKSUM_SAMPLE_INTERVAL = 16
+
+class MininodeLock(object):
+    """
+    Lock protecting data shared between NodeConnCB callbacks and the test logic.
+
+    Acquiring it normally (with mininode_lock: ...) is exclusive and
+    reentrant: the holder excludes every message delivery, so tests can
+    read or change callback state safely.  Deliveries themselves only hold
+    it in shared mode (with mininode_lock.shared(): ...), together with the
+    receiving callback's own lock, so that deliveries to different callbacks
+    run concurrently, and a test that only waits on one callback's state can
+    hold that callback's lock instead (see wait_until).
+
+    Locks are always acquired in this order: mininode_lock first, then a
+    NodeConnCB's lock.  Never acquire mininode_lock while holding a
+    NodeConnCB's lock; callbacks don't need to, as they already hold it in
+    shared mode.
+    """
 
-# One lock for synchronizing all data access between the networking thread (see
-# NetworkThread below) and the thread running the test logic.  For simplicity,
-# NodeConn acquires this lock whenever delivering a message to to a NodeConnCB,
-# and whenever adding anything to the send buffer (in send_message()).  This
-# lock should be acquired in the thread running the test logic to synchronize
-# access to any data shared with the NodeConnCB or NodeConn.
-mininode_lock = RLock()
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._owner = None
+        self._depth = 0
+        self._shared = 0 # shared holds of threads other than the owner
+        self._exclusive_waiters = 0
+        self._local = threading.local()
+
+    def _local_shared(self):
+        return getattr(self._local, "shared", 0)
+
+    def acquire(self, blocking=True, timeout=-1):
+        me = get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return True
+            mine = self._local_shared()
+            if blocking and timeout < 0:
+                # A thread holding the lock shared (a callback) gives that up
+                # while it waits, so that two such threads can't deadlock.
+                # It only gets it back on release(), as this can't fail.
+                self._shared -= mine
+                self._cond.notify_all()
+                held = 0
+            else:
+                # Attempts that may fail keep their shared hold, so that they
+                # can return False right away without having to get it back.
+                held = mine
+            available = lambda: self._owner is None and self._shared == held
+            self._exclusive_waiters += 1
+            if not blocking:
+                acquired = available()
+            else:
+                acquired = self._cond.wait_for(available, None if timeout < 0 else timeout)
+            self._exclusive_waiters -= 1
+            if not acquired:
+                # Shared acquires may have been waiting for exclusive waiters
+                self._cond.notify_all()
+                return False
+            self._shared -= held
+            self._owner = me
+            self._depth = 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._owner != get_ident():
+                raise RuntimeError("cannot release un-acquired lock")
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._shared += self._local_shared()
+                self._cond.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire_shared(self):
+        with self._cond:
+            mine = self._local_shared()
+            if self._owner != get_ident():
+                # Let waiting exclusive holders in first, unless this thread
+                # already holds the lock shared (they'd wait for it anyway)
+                self._cond.wait_for(lambda: self._owner is None and (mine or not self._exclusive_waiters))
+                self._shared += 1
+            self._local.shared = mine + 1
+
+    def release_shared(self):
+        with self._cond:
+            self._local.shared = self._local_shared() - 1
+            if self._owner != get_ident():
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+mininode_lock = MininodeLock()
+
+# Notified, together with an increment of mininode_events[0], whenever a
+# message has been delivered or a connection opened or closed, so that
+# wait_until can recheck its predicate.
+mininode_cond = Condition()
+mininode_events = [0]
+
+def notify_mininode_event():
+    with mininode_cond:
+        mininode_events[0] += 1
+        mininode_cond.notify_all()
+
+# NodeConnCB callbacks run on these threads rather than the NetworkThread,
+# through each NodeConnCB's DeliveryQueue.
+MAX_DELIVERY_THREADS = 8
+mininode_delivery_pool = ThreadPoolExecutor(max_workers=MAX_DELIVERY_THREADS)
+
+class DeliveryQueue(object):
+    """
+    Runs callbacks on mininode_delivery_pool one at a time, in the order
+    they were queued.
+
+    Every NodeConnCB has its own, so its callbacks see events in order, even
+    from several connections, while a slow callback only holds up its own
+    NodeConnCB.  NodeConnCBs whose callbacks share state with each other
+    must share one DeliveryQueue instead (as comptool's TestNodes do).
+    """
+    def __init__(self):
+        self.callbacks = deque()
+        self.lock = Lock()
+        self.scheduled = False
+
+    def put(self, callback, *args):
+        with self.lock:
+            self.callbacks.append((callback, args))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        try:
+            mininode_delivery_pool.submit(self.run)
+        except RuntimeError:
+            # The pool has been shut down (the interpreter is exiting), so
+            # run the callbacks here instead
+            self.run()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.callbacks:
+                    self.scheduled = False
+                    return
+                callback, args = self.callbacks.popleft()
+            try:
+                callback(*args)
+            except:
+                logger.exception("ERROR running mininode callback")
+            notify_mininode_event()
 
 # Serialization/deserialization tools
 def sha256(s):
@@ -88,45 +273,181 @@ def ser_compact_size(l):
         r = struct.pack("<BQ", 255, l)
     return r
 
+# Number of bytes ser_compact_size(l) produces, without building them
+def size_of_compact_size(l):
+    if l < 253:
+        return 1
+    elif l < 0x10000:
+        return 3
+    elif l < 0x100000000:
+        return 5
+    else:
+        return 9
+
+# Serialized length of ser_string(s)
+def size_of_string(s):
+    return size_of_compact_size(len(s)) + len(s)
+
+# Precompiled struct formats used by ByteReader
+struct_uint8 = struct.Struct("<B")
+struct_uint16 = struct.Struct("<H")
+struct_int32 = struct.Struct("<i")
+struct_uint32 = struct.Struct("<I")
+struct_int64 = struct.Struct("<q")
+struct_uint64 = struct.Struct("<Q")
+
+class ByteReader(object):
+    """Cursor over a memoryview, used for zero-copy deserialization.
+
+    Fields are decoded in place with precompiled struct.Struct objects and
+    unpack_from(), so no intermediate bytes objects are created for
+    fixed-size fields.  ByteReader also implements read(), so it can be
+    passed to any deserialize(f) method that expects a file-like object.
+    """
+    __slots__ = ("buf", "pos")
+
+    def __init__(self, data, pos=0):
+        self.buf = data if isinstance(data, memoryview) else memoryview(data)
+        self.pos = pos
+
+    def read(self, n=-1):
+        pos = self.pos
+        if n < 0:
+            n = len(self.buf) - pos
+        r = self.buf[pos:pos+n].tobytes()
+        self.pos = pos + len(r)
+        return r
+
+    def tell(self):
+        return self.pos
+
+    def read_uint8(self):
+        r = struct_uint8.unpack_from(self.buf, self.pos)[0]
+        self.pos += 1
+        return r
+
+    def read_int32(self):
+        r = struct_int32.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return r
+
+    def read_uint32(self):
+        r = struct_uint32.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return r
+
+    def read_int64(self):
+        r = struct_int64.unpack_from(self.buf, self.pos)[0]
+        self.pos += 8
+        return r
+
+    def read_uint64(self):
+        r = struct_uint64.unpack_from(self.buf, self.pos)[0]
+        self.pos += 8
+        return r
+
+    def read_compact_size(self):
+        buf = self.buf
+        pos = self.pos
+        nit = buf[pos]
+        if nit < 253:
+            self.pos = pos + 1
+        elif nit == 253:
+            nit = struct_uint16.unpack_from(buf, pos + 1)[0]
+            self.pos = pos + 3
+        elif nit == 254:
+            nit = struct_uint32.unpack_from(buf, pos + 1)[0]
+            self.pos = pos + 5
+        else:
+            nit = struct_uint64.unpack_from(buf, pos + 1)[0]
+            self.pos = pos + 9
+        return nit
+
+    def read_string(self):
+        buf = self.buf
+        pos = self.pos
+        n = buf[pos]
+        if n < 253:
+            pos += 1
+        else:
+            n = self.read_compact_size()
+            pos = self.pos
+        end = pos + n
+        self.pos = end
+        return buf[pos:end].tobytes()
+
+    def read_uint256(self):
+        pos = self.pos
+        end = pos + 32
+        if end > len(self.buf):
+            raise struct.error("read_uint256 requires 32 bytes")
+        self.pos = end
+        return int.from_bytes(self.buf[pos:end], 'little')
+
+    def read_vector(self, c):
+        r = []
+        append = r.append
+        for i in range(self.read_compact_size()):
+            t = c()
+            t.deserialize_from(self)
+            append(t)
+        return r
+
+    def read_uint256_vector(self):
+        return [self.read_uint256() for i in range(self.read_compact_size())]
+
+    def read_string_vector(self):
+        return [self.read_string() for i in range(self.read_compact_size())]
+
+    def read_int_vector(self):
+        return [self.read_int32() for i in range(self.read_compact_size())]
+
+def deser_from_stream(f, parse):
+    """Run parse(reader) against the file-like object f.
+
+    This is the thin wrapper that keeps the deserialize(f) API working on top
+    of ByteReader.  BytesIO streams are parsed in place through getbuffer();
+    any other seekable stream has its remainder read once.  Either way the
+    stream position is left just after the bytes that were consumed.
+    """
+    if isinstance(f, ByteReader):
+        return parse(f)
+    if isinstance(f, BytesIO):
+        start = f.tell()
+        with f.getbuffer() as buf:
+            r = ByteReader(buf, start)
+            try:
+                return parse(r)
+            finally:
+                f.seek(r.pos)
+    start = f.tell()
+    r = ByteReader(f.read())
+    try:
+        return parse(r)
+    finally:
+        f.seek(start + r.pos)
+
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    return nit
+    return deser_from_stream(f, ByteReader.read_compact_size)
 
 def deser_string(f):
-    nit = deser_compact_size(f)
-    return f.read(nit)
+    return deser_from_stream(f, ByteReader.read_string)
 
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return deser_from_stream(f, ByteReader.read_uint256)
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & ((1 << 256) - 1)).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    if len(s) < 32:
+        raise struct.error("uint256_from_str requires 32 bytes")
+    return int.from_bytes(s[:32], 'little')
 
 
 def uint256_from_compact(c):
@@ -136,6 +457,8 @@ def uint256_from_compact(c):
 
 
 def deser_vector(f, c):
+    if hasattr(c, 'deserialize_from'):
+        return deser_from_stream(f, lambda r: r.read_vector(c))
     nit = deser_compact_size(f)
     r = []
     for i in range(nit):
@@ -149,65 +472,51 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
         if ser_function_name:
             r += getattr(i, ser_function_name)()
         else:
             r += i.serialize()
-    return r
+    return bytes(r)
 
 
 def deser_uint256_vector(f):
-    nit = deser_compact_size(f)
-    r = []
-    for i in range(nit):
-        t = deser_uint256(f)
-        r.append(t)
-    return r
+    return deser_from_stream(f, ByteReader.read_uint256_vector)
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
         r += ser_uint256(i)
-    return r
+    return bytes(r)
 
 
 def deser_string_vector(f):
-    nit = deser_compact_size(f)
-    r = []
-    for i in range(nit):
-        t = deser_string(f)
-        r.append(t)
-    return r
+    return deser_from_stream(f, ByteReader.read_string_vector)
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for sv in l:
-        r += ser_string(sv)
-    return r
+        r += ser_compact_size(len(sv))
+        r += sv
+    return bytes(r)
 
 
 def deser_int_vector(f):
-    nit = deser_compact_size(f)
-    r = []
-    for i in range(nit):
-        t = struct.unpack("<i", f.read(4))[0]
-        r.append(t)
-    return r
+    return deser_from_stream(f, ByteReader.read_int_vector)
 
 
 def ser_int_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
-        r += struct.pack("<i", i)
-    return r
+        r += struct_int32.pack(i)
+    return bytes(r)
 
 # Deserialize from a hex string representation (eg from RPC)
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(hex_str_to_bytes(hex_string)))
+    obj.deserialize(ByteReader(hex_str_to_bytes(hex_string)))
     return obj
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
@@ -217,6 +526,8 @@ def ToHex(obj):
 # Objects that map to bitcoind objects, which can be serialized/deserialized
 
 class CAddress(object):
+    __slots__ = ("nServices", "pchReserved", "ip", "port")
+
     def __init__(self):
         self.nServices = 1
         self.pchReserved = b"\x00" * 10 + b"\xff" * 2
@@ -224,10 +535,13 @@ class CAddress(object):
         self.port = 0
 
     def deserialize(self, f):
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.pchReserved = f.read(12)
-        self.ip = socket.inet_ntoa(f.read(4))
-        self.port = struct.unpack(">H", f.read(2))[0]
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
+        self.nServices = r.read_uint64()
+        self.pchReserved = r.read(12)
+        self.ip = socket.inet_ntoa(r.read(4))
+        self.port = struct.unpack(">H", r.read(2))[0]
 
     def serialize(self):
         r = b""
@@ -253,13 +567,18 @@ class CInv(object):
         4: "CompactBlock"
     }
 
+    __slots__ = ("type", "hash")
+
     def __init__(self, t=0, h=0):
         self.type = t
         self.hash = h
 
     def deserialize(self, f):
-        self.type = struct.unpack("<i", f.read(4))[0]
-        self.hash = deser_uint256(f)
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
+        self.type = r.read_int32()
+        self.hash = r.read_uint256()
 
     def serialize(self):
         r = b""
@@ -293,25 +612,41 @@ class CBlockLocator(object):
 
 
 class COutPoint(object):
+    __slots__ = ("hash", "n")
+
     def __init__(self, hash=0, n=0):
         self.hash = hash
         self.n = n
 
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
+        self.hash = r.read_uint256()
+        self.n = r.read_uint32()
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, w):
+        w += ser_uint256(self.hash)
+        w += struct_uint32.pack(self.n)
+
+    def get_serialized_size(self):
+        return 36
+
+    def copy(self):
+        return COutPoint(self.hash, self.n)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
 class CTxIn(object):
+    __slots__ = ("prevout", "scriptSig", "nSequence")
+
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
             self.prevout = COutPoint()
@@ -321,17 +656,34 @@ class CTxIn(object):
         self.nSequence = nSequence
 
     def deserialize(self, f):
-        self.prevout = COutPoint()
-        self.prevout.deserialize(f)
-        self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
+        buf = r.buf
+        pos = r.pos
+        self.prevout = COutPoint(int.from_bytes(buf[pos:pos+32], 'little'),
+                                 struct_uint32.unpack_from(buf, pos + 32)[0])
+        r.pos = pos + 36
+        self.scriptSig = r.read_string()
+        self.nSequence = r.read_uint32()
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, w):
+        self.prevout.serialize_into(w)
+        w += ser_compact_size(len(self.scriptSig))
+        w += self.scriptSig
+        w += struct_uint32.pack(self.nSequence)
+
+    def get_serialized_size(self):
+        return 36 + size_of_string(self.scriptSig) + 4
+
+    # Scripts are immutable bytes, so only the outpoint needs copying
+    def copy(self):
+        return CTxIn(self.prevout.copy(), self.scriptSig, self.nSequence)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -340,19 +692,35 @@ class CTxIn(object):
 
 
 class CTxOut(object):
+    __slots__ = ("nValue", "scriptPubKey")
+
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
-        self.scriptPubKey = deser_string(f)
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
+        self.nValue = struct_int64.unpack_from(r.buf, r.pos)[0]
+        r.pos += 8
+        self.scriptPubKey = r.read_string()
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, w):
+        w += struct_int64.pack(self.nValue)
+        w += ser_compact_size(len(self.scriptPubKey))
+        w += self.scriptPubKey
+
+    def get_serialized_size(self):
+        return 8 + size_of_string(self.scriptPubKey)
+
+    def copy(self):
+        return CTxOut(self.nValue, self.scriptPubKey)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -361,10 +729,17 @@ class CTxOut(object):
 
 
 class CScriptWitness(object):
+    __slots__ = ("stack",)
+
     def __init__(self):
         # stack is a vector of strings
         self.stack = []
 
+    def copy(self):
+        r = CScriptWitness()
+        r.stack = list(self.stack)
+        return r
+
     def __repr__(self):
         return "CScriptWitness(%s)" % \
                (",".join([bytes_to_hex_str(x) for x in self.stack]))
@@ -376,15 +751,36 @@ class CScriptWitness(object):
 
 
 class CTxInWitness(object):
+    __slots__ = ("scriptWitness",)
+
     def __init__(self):
         self.scriptWitness = CScriptWitness()
 
     def deserialize(self, f):
-        self.scriptWitness.stack = deser_string_vector(f)
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
+        self.scriptWitness.stack = r.read_string_vector()
 
     def serialize(self):
         return ser_string_vector(self.scriptWitness.stack)
 
+    def serialize_into(self, w):
+        stack = self.scriptWitness.stack
+        w += ser_compact_size(len(stack))
+        for x in stack:
+            w += ser_compact_size(len(x))
+            w += x
+
+    def get_serialized_size(self):
+        stack = self.scriptWitness.stack
+        return size_of_compact_size(len(stack)) + sum(size_of_string(x) for x in stack)
+
+    def copy(self):
+        r = CTxInWitness()
+        r.scriptWitness = self.scriptWitness.copy()
+        return r
+
     def __repr__(self):
         return repr(self.scriptWitness)
 
@@ -397,16 +793,30 @@ class CTxWitness(object):
         self.vtxinwit = []
 
     def deserialize(self, f):
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
         for i in range(len(self.vtxinwit)):
-            self.vtxinwit[i].deserialize(f)
+            self.vtxinwit[i].deserialize_from(r)
 
     def serialize(self):
-        r = b""
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, w):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
+            x.serialize_into(w)
+
+    def get_serialized_size(self):
+        return sum(x.get_serialized_size() for x in self.vtxinwit)
+
+    def copy(self):
+        r = CTxWitness()
+        r.vtxinwit = [x.copy() for x in self.vtxinwit]
         return r
 
     def __repr__(self):
@@ -421,6 +831,11 @@ class CTxWitness(object):
 
 
 class CTransaction(object):
+    """A transaction.
+
+    CTransaction(tx) copies tx.  The inputs, outputs and witnesses are cloned
+    structurally, which is much cheaper than copy.deepcopy.
+    """
     def __init__(self, tx=None):
         if tx is None:
             self.nVersion = 1
@@ -430,65 +845,91 @@ class CTransaction(object):
             self.nLockTime = 0
             self.sha256 = None
             self.hash = None
+            self.wsha256 = None
         else:
             self.nVersion = tx.nVersion
-            self.vin = copy.deepcopy(tx.vin)
-            self.vout = copy.deepcopy(tx.vout)
             self.nLockTime = tx.nLockTime
             self.sha256 = tx.sha256
             self.hash = tx.hash
-            self.wit = copy.deepcopy(tx.wit)
+            self.wsha256 = tx.wsha256
+            self.vin = [x.copy() for x in tx.vin]
+            self.vout = [x.copy() for x in tx.vout]
+            self.wit = tx.wit.copy()
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.vin = deser_vector(f, CTxIn)
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
+        self.nVersion = r.read_int32()
+        self.vin = r.read_vector(CTxIn)
         flags = 0
         if len(self.vin) == 0:
-            flags = struct.unpack("<B", f.read(1))[0]
+            flags = r.read_uint8()
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if (flags != 0):
-                self.vin = deser_vector(f, CTxIn)
-                self.vout = deser_vector(f, CTxOut)
+                self.vin = r.read_vector(CTxIn)
+                self.vout = r.read_vector(CTxOut)
         else:
-            self.vout = deser_vector(f, CTxOut)
+            self.vout = r.read_vector(CTxOut)
         if flags != 0:
             self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
-            self.wit.deserialize(f)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+            self.wit.deserialize_from(r)
+        self.nLockTime = r.read_uint32()
         self.sha256 = None
         self.hash = None
+        self.wsha256 = None
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        r = bytearray()
+        self.serialize_into(r, with_witness=True)
+        return bytes(r)
+
+    # Append the serialization to the bytearray w in a single pass
+    def serialize_into(self, w, with_witness=False):
         flags = 0
-        if not self.wit.is_null():
+        if with_witness and not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        w += struct_int32.pack(self.nVersion)
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            w += ser_compact_size(len(dummy))
+            w += struct_uint8.pack(flags)
+        w += ser_compact_size(len(self.vin))
+        for txin in self.vin:
+            txin.serialize_into(w)
+        w += ser_compact_size(len(self.vout))
+        for txout in self.vout:
+            txout.serialize_into(w)
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            self.wit.serialize_into(w)
+        w += struct_uint32.pack(self.nLockTime)
+
+    # Compute len(serialize_with_witness()) or len(serialize_without_witness())
+    # without building the serialization.
+    def get_serialized_size(self, with_witness=False):
+        size = 4 + size_of_compact_size(len(self.vin)) + size_of_compact_size(len(self.vout)) + 4
+        size += sum(txin.get_serialized_size() for txin in self.vin)
+        size += sum(txout.get_serialized_size() for txout in self.vout)
+        if with_witness and not self.wit.is_null():
+            # marker and flag bytes, then one witness per input (inputs
+            # without a witness serialize as an empty stack)
+            size += 2
+            vtxinwit = self.wit.vtxinwit[:len(self.vin)]
+            size += sum(x.get_serialized_size() for x in vtxinwit)
+            size += len(self.vin) - len(vtxinwit)
+        return size
 
     # Regular serialization is without witness -- must explicitly
     # call serialize_with_witness to include witness data.
@@ -500,16 +941,26 @@ class CTransaction(object):
         self.sha256 = None
         self.calc_sha256()
 
-    # We will only cache the serialization without witness in
-    # self.sha256 and self.hash -- those are expected to be the txid.
+    # We will only store the hash without witness in self.sha256 and
+    # self.hash -- those are expected to be the txid.  sha256 is None
+    # while the txid needs (re)computing; after changing a transaction,
+    # call rehash() to clear it.  Both are set from a single digest.
+    # The wtxid is cached in self.wsha256, but only trusted while sha256 is
+    # set, and dropped whenever the txid is recomputed.
     def calc_sha256(self, with_witness=False):
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
+            if self.sha256 is not None and self.wsha256 is not None:
+                return self.wsha256
+            wsha256 = uint256_from_str(hash256(self.serialize_with_witness()))
+            if self.sha256 is not None:
+                self.wsha256 = wsha256
+            return wsha256
 
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize())[::-1], 'hex_codec').decode('ascii')
+            self.wsha256 = None
+            h = hash256(self.serialize_without_witness())
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
 
     def is_valid(self):
         self.calc_sha256()
@@ -524,6 +975,11 @@ class CTransaction(object):
 
 
 class CBlockHeader(object):
+    # Subclasses without their own __slots__ (such as CBlock) still get a
+    # __dict__, so only plain headers are kept compact.
+    __slots__ = ("nVersion", "hashPrevBlock", "hashMerkleRoot", "nTime",
+                 "nBits", "nNonce", "sha256", "hash")
+
     def __init__(self, header=None):
         if header is None:
             self.set_null()
@@ -549,36 +1005,44 @@ class CBlockHeader(object):
         self.hash = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        deser_from_stream(f, self.deserialize_from)
+
+    def deserialize_from(self, r):
+        self.nVersion = r.read_int32()
+        self.hashPrevBlock = r.read_uint256()
+        self.hashMerkleRoot = r.read_uint256()
+        self.nTime = r.read_uint32()
+        self.nBits = r.read_uint32()
+        self.nNonce = r.read_uint32()
         self.sha256 = None
         self.hash = None
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        return self.serialize_header()
+
+    def serialize_into(self, w):
+        w += self.serialize_header()
+
+    # Serialize just the 80-byte header, also for CBlock instances
+    def serialize_header(self):
+        r = bytearray()
+        r += struct_int32.pack(self.nVersion)
         r += ser_uint256(self.hashPrevBlock)
         r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        r += struct_uint32.pack(self.nTime)
+        r += struct_uint32.pack(self.nBits)
+        r += struct_uint32.pack(self.nNonce)
+        return bytes(r)
+
+    def get_serialized_size(self):
+        return 80
 
+    # sha256 and hash are kept until rehash(), and set from a single digest
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
+            h = hash256(self.serialize_header())
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
 
     def rehash(self):
         self.sha256 = None
@@ -591,23 +1055,168 @@ class CBlockHeader(object):
                time.ctime(self.nTime), self.nBits, self.nNonce)
 
 
+def find_nonce(prefix, target, start=0, end=1 << 32):
+    """Return the lowest nonce in [start, end) whose block hash is at most
+    target, or None.
+
+    prefix is the first 76 bytes of the serialized header.  Its first 64
+    bytes are one SHA256 block, so their midstate is computed once and
+    copied for every nonce.
+    """
+    midstate = hashlib.sha256(prefix[:64])
+    tail = prefix[64:]
+    pack = struct_uint32.pack
+    sha256 = hashlib.sha256
+    for nonce in range(start, end):
+        h = midstate.copy()
+        h.update(tail + pack(nonce))
+        if int.from_bytes(sha256(h.digest()).digest(), 'little') <= target:
+            return nonce
+    return None
+
+# Nonces searched by one worker task in find_nonce_parallel
+NONCE_CHUNK_SIZE = 1 << 18
+
+def find_nonce_parallel(prefix, target, start=0, processes=4):
+    """find_nonce over [start, 2^32), with consecutive chunks of the range
+    searched by a pool of worker processes.  The result is the same as
+    find_nonce's."""
+    end = 1 << 32
+    with ProcessPoolExecutor(processes) as executor:
+        while start < end:
+            bounds = []
+            for i in range(processes):
+                lo = start + i * NONCE_CHUNK_SIZE
+                if lo < end:
+                    bounds.append((lo, min(lo + NONCE_CHUNK_SIZE, end)))
+            futures = [executor.submit(find_nonce, prefix, target, lo, hi) for lo, hi in bounds]
+            # Chunks are in order, so the first hit is the lowest nonce.
+            for future in futures:
+                nonce = future.result()
+                if nonce is not None:
+                    return nonce
+            start = bounds[-1][1]
+    return None
+
+
+class MerkleTree(object):
+    """Merkle tree over serialized hashes that keeps all of its levels.
+
+    levels[0] holds the leaves and levels[-1] the root.  Changing leaves only
+    rehashes the nodes above them, so appending or replacing a leaf costs
+    O(log n) hashes.
+    """
+    def __init__(self, leaves=None):
+        self.levels = [[]]
+        if leaves:
+            self.set_leaves(leaves)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def append(self, leaf):
+        self.levels[0].append(leaf)
+        self._update([len(self.levels[0]) - 1])
+
+    def replace(self, index, leaf):
+        self.levels[0][index] = leaf
+        self._update([index])
+
+    def set_leaves(self, leaves):
+        """Make leaves the tree's leaves, rehashing only what changed."""
+        old = self.levels[0]
+        if len(leaves) < len(old):
+            self.levels = [list(leaves)]
+            self._update(range(len(leaves)))
+            return
+        dirty = [i for i in range(len(old)) if old[i] != leaves[i]]
+        dirty.extend(range(len(old), len(leaves)))
+        self.levels[0] = list(leaves)
+        self._update(dirty)
+
+    def _update(self, dirty):
+        # Rehash the parents of the dirty nodes, one level at a time.  An odd
+        # node out at the end of a level is paired with itself.
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[level + 1]
+            dirty = sorted(set(i >> 1 for i in dirty))
+            for i in dirty:
+                left = nodes[2 * i]
+                right = nodes[2 * i + 1] if 2 * i + 1 < len(nodes) else left
+                if i < len(parents):
+                    parents[i] = hash256(left + right)
+                else:
+                    parents.append(hash256(left + right))
+            level += 1
+        del self.levels[level + 1:]
+
+    def root(self):
+        if not self.levels[0]:
+            return 0
+        return uint256_from_str(self.levels[-1][0])
+
+    def get_branch(self, index):
+        """Return the sibling hashes on the path from leaf index to the root."""
+        branch = []
+        for nodes in self.levels[:-1]:
+            sibling = index ^ 1
+            branch.append(nodes[sibling] if sibling < len(nodes) else nodes[index])
+            index >>= 1
+        return branch
+
+# Calculate the merkle root from a leaf, its index and its merkle branch
+def merkle_root_from_branch(leaf, branch, index):
+    h = leaf
+    for sibling in branch:
+        if index & 1:
+            h = hash256(sibling + h)
+        else:
+            h = hash256(h + sibling)
+        index >>= 1
+    return uint256_from_str(h)
+
+
 class CBlock(CBlockHeader):
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
-
-    def deserialize(self, f):
-        super(CBlock, self).deserialize(f)
-        self.vtx = deser_vector(f, CTransaction)
-
+        # Merkle trees of the last calc_merkle_root()/calc_witness_merkle_root()
+        # calls, so that recalculating only rehashes what changed.
+        self._merkle_tree = MerkleTree()
+        self._witness_merkle_tree = MerkleTree()
+
+    def deserialize_from(self, r):
+        super(CBlock, self).deserialize_from(r)
+        self.vtx = r.read_vector(CTransaction)
+
+    # Transactions are serialized through their own serialize methods so
+    # that subclasses overriding them are honoured; serialize_into() is the
+    # single-pass variant for plain CTransactions.
     def serialize(self, with_witness=False):
-        r = b""
-        r += super(CBlock, self).serialize()
-        if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
-        else:
-            r += ser_vector(self.vtx)
-        return r
+        r = bytearray(self.serialize_header())
+        r += ser_compact_size(len(self.vtx))
+        for tx in self.vtx:
+            if with_witness:
+                r += tx.serialize_with_witness()
+            else:
+                r += tx.serialize()
+        return bytes(r)
+
+    def serialize_into(self, w, with_witness=False):
+        w += self.serialize_header()
+        w += ser_compact_size(len(self.vtx))
+        for tx in self.vtx:
+            tx.serialize_into(w, with_witness)
+
+    # Compute len(serialize(with_witness)) without building the serialization
+    def get_serialized_size(self, with_witness=False):
+        size = 80 + size_of_compact_size(len(self.vtx))
+        size += sum(tx.get_serialized_size(with_witness) for tx in self.vtx)
+        return size
 
     # Calculate the merkle root given a vector of transaction hashes
     def get_merkle_root(self, hashes):
@@ -624,7 +1233,13 @@ class CBlock(CBlockHeader):
         for tx in self.vtx:
             tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        self._merkle_tree.set_leaves(hashes)
+        return self._merkle_tree.root()
+
+    # Return the merkle branch of transaction index, as of the last
+    # calc_merkle_root() call
+    def get_merkle_branch(self, index):
+        return self._merkle_tree.get_branch(index)
 
     def calc_witness_merkle_root(self):
         # For witness root purposes, the hash of the
@@ -635,7 +1250,8 @@ class CBlock(CBlockHeader):
             # Calculate the hashes with witness data
             hashes.append(ser_uint256(tx.calc_sha256(True)))
 
-        return self.get_merkle_root(hashes)
+        self._witness_merkle_tree.set_leaves(hashes)
+        return self._witness_merkle_tree.root()
 
     def is_valid(self):
         self.calc_sha256()
@@ -649,12 +1265,28 @@ class CBlock(CBlockHeader):
             return False
         return True
 
-    def solve(self):
+    def solve(self, processes=None):
+        """Find the lowest nNonce, starting from the current one, that
+        satisfies nBits.
+
+        With processes set to more than one, nonce ranges are searched by
+        that many worker processes, which only pays off for targets much
+        harder than regtest's.
+        """
         self.rehash()
         target = uint256_from_compact(self.nBits)
-        while self.sha256 > target:
-            self.nNonce += 1
-            self.rehash()
+        if self.sha256 <= target:
+            return
+        prefix = self.serialize_header()[:76]
+        start = self.nNonce + 1
+        if processes is not None and processes > 1:
+            nonce = find_nonce_parallel(prefix, target, start, processes)
+        else:
+            nonce = find_nonce(prefix, target, start)
+        if nonce is None:
+            raise ValueError("No nonce satisfies nBits %08x" % self.nBits)
+        self.nNonce = nonce
+        self.rehash()
 
     def __repr__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=%s)" \
@@ -813,6 +1445,13 @@ def calculate_shortid(k0, k1, tx_hash):
     expected_shortid &= 0x0000ffffffffffff
     return expected_shortid
 
+# Calculate the shortids for many transaction hashes under the same keys
+def calculate_shortids(k0, k1, tx_hashes):
+    if siphash.numpy is None:
+        # Without NumPy, batching saves next to nothing
+        return [calculate_shortid(k0, k1, h) for h in tx_hashes]
+    return [x & 0x0000ffffffffffff for x in siphash256_many(k0, k1, tx_hashes)]
+
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
 class HeaderAndShortIDs(object):
@@ -865,12 +1504,15 @@ class HeaderAndShortIDs(object):
         self.shortids = []
         self.use_witness = use_witness
         [k0, k1] = self.get_siphash_keys()
+        prefilled = set(prefill_list)
+        tx_hashes = []
         for i in range(len(block.vtx)):
-            if i not in prefill_list:
+            if i not in prefilled:
                 tx_hash = block.vtx[i].sha256
                 if use_witness:
                     tx_hash = block.vtx[i].calc_sha256(with_witness=True)
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+                tx_hashes.append(tx_hash)
+        self.shortids = calculate_shortids(k0, k1, tx_hashes)
 
     def __repr__(self):
         return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
@@ -940,6 +1582,84 @@ class BlockTransactions(object):
 
 
 # Objects that correspond to messages on the wire
+class LazyMessage(object):
+    """
+    Base for received messages whose payload is only deserialized when one
+    of their attributes is first accessed.  NodeConn creates these (see
+    lazy_message) for every command not in its eager_commands, so messages
+    a handler ignores are never parsed.  They are still instances of the
+    message class, and command is available without decoding.
+
+    If the NodeConn defers checksum verification, the payload is checked
+    against _checksum when it is decoded, and a mismatch raises ValueError.
+    repr() doesn't decode the message.
+    """
+    def __getattr__(self, name):
+        # Only reached for attributes that aren't set, i.e. before decoding
+        if name.startswith("__"):
+            raise AttributeError(name)
+        self.decode()
+        return object.__getattribute__(self, name)
+
+    def __setattr__(self, name, value):
+        self.decode()
+        object.__setattr__(self, name, value)
+
+    def decode(self):
+        if "_payload" not in self.__dict__:
+            return
+        with _lazy_decode_locks[id(self) % len(_lazy_decode_locks)]:
+            payload = self.__dict__.get("_payload")
+            if payload is None:
+                return # decoded by another thread meanwhile
+            checksum = self.__dict__.get("_checksum")
+            if checksum is not None and hash256(payload)[:4] != checksum:
+                raise ValueError("got bad checksum for %s message" % self.command.decode('ascii'))
+            # Decode into a separate message and only publish its fields
+            # once it is complete, so that no thread sees a partly decoded
+            # message.
+            decoded = self._message_class()
+            decoded.deserialize(ByteReader(payload))
+            self.__dict__.update(decoded.__dict__)
+            del self.__dict__["_payload"]
+            self.__dict__.pop("_checksum", None)
+
+    def __repr__(self):
+        payload = self.__dict__.get("_payload")
+        if payload is not None:
+            return "%s(<%d bytes, not decoded>)" % (self._message_class.__name__, len(payload))
+        return self._message_class.__repr__(self)
+
+# Decoding a LazyMessage holds one of these, picked by the message's id(),
+# so messages are decoded once and different messages rarely wait for
+# each other.
+_lazy_decode_locks = [Lock() for _ in range(64)]
+
+_lazy_message_classes = {}
+
+def lazy_message(cls, payload, checksum=None):
+    """Return a cls message that deserializes payload when first used.
+
+    If checksum is given, the payload is verified against it at that point.
+    """
+    lazy_cls = _lazy_message_classes.get(cls)
+    if lazy_cls is None:
+        lazy_cls = type(cls.__name__, (LazyMessage, cls), {"_message_class": cls})
+        _lazy_message_classes[cls] = lazy_cls
+    m = lazy_cls.__new__(lazy_cls)
+    m.__dict__["_payload"] = payload
+    if checksum is not None:
+        m.__dict__["_checksum"] = checksum
+    return m
+
+def is_loopback_address(addr):
+    if addr == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(addr).is_loopback
+    except ValueError:
+        return False
+
 class msg_version(object):
     command = b"version"
 
@@ -1355,19 +2075,33 @@ class msg_reject(object):
             % (self.message, self.code, self.reason, self.data)
 
 # Helper function
-def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf')):
-    attempt = 0
-    elapsed = 0
-
-    while attempt < attempts and elapsed < timeout:
-        with mininode_lock:
+# wait_until rechecks its predicate at least this often, in case it depends on
+# something other than delivered messages.  attempts are counted in these.
+WAIT_UNTIL_POLL_INTERVAL = 0.05
+
+def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=None):
+    """
+    Wait until predicate() is true, checking it after every message delivered
+    with lock held: by default mininode_lock, or the lock of the only
+    NodeConnCB whose state predicate reads.  Gives up after timeout seconds or
+    attempts polling intervals, whichever comes first; returns whether it
+    succeeded.
+    """
+    if lock is None:
+        lock = mininode_lock
+    deadline = time.time() + min(timeout, attempts * WAIT_UNTIL_POLL_INTERVAL)
+    while True:
+        with mininode_cond:
+            seen = mininode_events[0]
+        with lock:
             if predicate():
                 return True
-        attempt += 1
-        elapsed += 0.05
-        time.sleep(0.05)
-
-    return False
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        with mininode_cond:
+            if mininode_events[0] == seen:
+                mininode_cond.wait(min(remaining, WAIT_UNTIL_POLL_INTERVAL))
 
 class msg_feefilter(object):
     command = b"feefilter"
@@ -1468,7 +2202,7 @@ class msg_witness_blocktxn(msg_blocktxn):
 # This is what a callback should look like for NodeConn
 # Reimplement the on_* functions to provide handling for events
 class NodeConnCB(object):
-    def __init__(self):
+    def __init__(self, delivery_queue=None):
         self.verack_received = False
         # deliver_sleep_time is helpful for debugging race conditions in p2p
         # tests; it causes message delivery to sleep for the specified time
@@ -1476,13 +2210,19 @@ class NodeConnCB(object):
         self.deliver_sleep_time = None
         # Remember the services our peer has advertised
         self.peer_services = None
+        # Held (after mininode_lock in shared mode) while delivering to this
+        # callback, so it never sees two messages at once
+        self.lock = RLock()
+        # Pass the same DeliveryQueue to callbacks that share state, so they
+        # are never delivered to concurrently
+        self.delivery_queue = delivery_queue if delivery_queue is not None else DeliveryQueue()
 
     def set_deliver_sleep_time(self, value):
-        with mininode_lock:
+        with self.lock:
             self.deliver_sleep_time = value
 
     def get_deliver_sleep_time(self):
-        with mininode_lock:
+        with self.lock:
             return self.deliver_sleep_time
 
     # Spin until verack message is received from the node.
@@ -1490,17 +2230,13 @@ class NodeConnCB(object):
     # This can be called from the testing thread, so it needs to acquire the
     # global lock.
     def wait_for_verack(self):
-        while True:
-            with mininode_lock:
-                if self.verack_received:
-                    return
-            time.sleep(0.05)
+        wait_until(lambda: self.verack_received, lock=self.lock)
 
     def deliver(self, conn, message):
         deliver_sleep = self.get_deliver_sleep_time()
         if deliver_sleep is not None:
             time.sleep(deliver_sleep)
-        with mininode_lock:
+        with mininode_lock.shared(), self.lock:
             try:
                 getattr(self, 'on_' + message.command.decode('ascii'))(conn, message)
             except:
@@ -1577,13 +2313,23 @@ class SingleNodeConnCB(NodeConnCB):
         def received_pong():
             return (self.last_pong.nonce == self.ping_counter)
         self.send_message(msg_ping(nonce=self.ping_counter))
-        success = wait_until(received_pong, timeout=timeout)
+        success = wait_until(received_pong, timeout=timeout, lock=self.lock)
         self.ping_counter += 1
         return success
 
 # The actual NodeConn class
 # This class provides an interface for a p2p connection to a specified node
-class NodeConn(asyncore.dispatcher):
+class NodeConn(_NodeConnProtocol):
+    """
+    A p2p connection to a bitcoind, run on mininode_loop by the NetworkThread.
+
+    Apart from send_message and disconnect_node, which may be called from
+    any thread, all methods run in the NetworkThread.
+
+    checksums selects how received checksums are verified (see
+    CHECKSUM_MODES).  Checksums of sent messages are always computed, as
+    bitcoind drops messages with a bad one.
+    """
     messagemap = {
         b"version": msg_version,
         b"verack": msg_verack,
@@ -1608,19 +2354,37 @@ class NodeConn(asyncore.dispatcher):
         b"getblocktxn": msg_getblocktxn,
         b"blocktxn": msg_blocktxn
     }
+    # Messages that are deserialized as soon as they are received; all
+    # others are delivered as a LazyMessage and only parsed if used.
+    # Can be overridden per connection.
+    eager_commands = frozenset([b"version"])
     MAGIC_BYTES = {
         "mainnet": b"\xf9\xbe\xb4\xd9",   # mainnet
         "testnet3": b"\x0b\x11\x09\x07",  # testnet3
         "regtest": b"\xfa\xbf\xb5\xda",   # regtest
     }
 
-    def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=NODE_NETWORK, send_version=True):
-        asyncore.dispatcher.__init__(self, map=mininode_socket_map)
+    def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=NODE_NETWORK, send_version=True, checksums="always"):
+        if checksums not in CHECKSUM_MODES:
+            raise ValueError("Unknown checksum mode %s (available: %s)" % (checksums, ", ".join(CHECKSUM_MODES)))
+        if checksums != "always" and not is_loopback_address(dstaddr):
+            raise ValueError("Checksum mode %s is only allowed for loopback peers, not %s" % (checksums, dstaddr))
         self.dstaddr = dstaddr
         self.dstport = dstport
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sendbuf = b""
-        self.recvbuf = b""
+        self.transport = None
+        # Framed messages not yet handed to the transport, as memoryviews
+        # of their header and payload, and backpressure statistics
+        self.send_queue = deque()
+        self.send_queue_bytes = 0
+        self.send_queue_peak = 0
+        self.send_pauses = 0
+        self.write_paused = False
+        # Received data is recvbuf[recv_start:recv_end]
+        self.recvbuf = bytearray(RECV_BUFFER_SIZE)
+        self.recv_start = 0
+        self.recv_end = 0
+        self.checksums = checksums
+        self.checksum_count = 0
         self.ver_send = 209
         self.ver_recv = 209
         self.last_sent = 0
@@ -1629,6 +2393,8 @@ class NodeConn(asyncore.dispatcher):
         self.cb = callback
         self.disconnect = False
         self.nServices = 0
+        with mininode_connections_lock:
+            mininode_connections.add(self)
 
         if send_version:
             # stuff version msg into sendbuf
@@ -1642,123 +2408,205 @@ class NodeConn(asyncore.dispatcher):
 
         logger.info('Connecting to Bitcoin Node: %s:%d' % (self.dstaddr, self.dstport))
 
-        try:
-            self.connect((dstaddr, dstport))
-        except:
-            self.handle_close()
         self.rpc = rpc
+        mininode_loop.call_soon_threadsafe(self.start_connect)
+
+    def start_connect(self):
+        if self.state != "connecting":
+            return # disconnected before the network thread got to it
+        connect = mininode_loop.create_task(
+            mininode_loop.create_connection(lambda: self, self.dstaddr, self.dstport))
+        connect.add_done_callback(self.connect_done)
+
+    def connect_done(self, future):
+        if future.cancelled() or future.exception() is not None:
+            self.handle_close()
+
+    # asyncio.Protocol callbacks
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=SEND_BUFFER_HIGH_WATER)
+        if self.state != "connecting":
+            transport.close()
+            return
+        self.handle_connect()
+
+    def connection_lost(self, exc):
+        self.handle_close()
+
+    def pause_writing(self):
+        self.write_paused = True
+        self.send_pauses += 1
+
+    def resume_writing(self):
+        self.write_paused = False
+        self.flush_send_queue()
+
+    def get_buffer(self, sizehint):
+        self.reserve_recv_space(RECV_READ_SIZE)
+        return memoryview(self.recvbuf)[self.recv_end:]
+
+    def buffer_updated(self, nbytes):
+        self.recv_end += nbytes
+        self.got_data()
+
+    def data_received(self, data):
+        # Only called on Pythons without BufferedProtocol
+        self.reserve_recv_space(len(data))
+        self.recvbuf[self.recv_end:self.recv_end+len(data)] = data
+        self.recv_end += len(data)
+        self.got_data()
+
+    def reserve_recv_space(self, size):
+        """Make room for size more bytes at the end of recvbuf."""
+        if len(self.recvbuf) - self.recv_end >= size:
+            return
+        # Move the unparsed data to the front, then grow if that's not enough
+        pending = self.recv_end - self.recv_start
+        if self.recv_start:
+            self.recvbuf[:pending] = self.recvbuf[self.recv_start:self.recv_end]
+            self.recv_start = 0
+            self.recv_end = pending
+        if len(self.recvbuf) - pending < size:
+            self.recvbuf.extend(bytes(max(len(self.recvbuf), pending + size - len(self.recvbuf))))
 
     def handle_connect(self):
-        if self.state != "connected":
-            logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
-            self.state = "connected"
-            self.cb.on_open(self)
+        logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
+        self.state = "connected"
+        self.flush_send_queue()
+        self.queue_callback(self.call_locked, self.cb.on_open, self)
 
     def handle_close(self):
+        if self.state == "closed":
+            return
         logger.debug("Closing connection to: %s:%d" % (self.dstaddr, self.dstport))
         self.state = "closed"
-        self.recvbuf = b""
-        self.sendbuf = b""
-        try:
-            self.close()
-        except:
-            pass
-        self.cb.on_close(self)
-
-    def handle_read(self):
+        self.recv_start = self.recv_end = 0
+        self.send_queue.clear()
+        self.send_queue_bytes = 0
         try:
-            t = self.recv(8192)
-            if len(t) > 0:
-                self.recvbuf += t
-                self.got_data()
-        except:
-            pass
-
-    def readable(self):
-        return True
-
-    def writable(self):
-        with mininode_lock:
-            pre_connection = self.state == "connecting"
-            length = len(self.sendbuf)
-        return (length > 0 or pre_connection)
-
-    def handle_write(self):
-        with mininode_lock:
-            # asyncore does not expose socket connection, only the first read/write
-            # event, thus we must check connection manually here to know when we
-            # actually connect
-            if self.state == "connecting":
-                self.handle_connect()
-            if not self.writable():
-                return
-
-            try:
-                sent = self.send(self.sendbuf)
-            except:
-                self.handle_close()
-                return
-            self.sendbuf = self.sendbuf[sent:]
+            if self.transport is not None:
+                self.transport.close()
+            self.queue_callback(self.call_locked, self.cb.on_close, self)
+        finally:
+            with mininode_connections_lock:
+                mininode_connections.discard(self)
+                if not mininode_connections:
+                    mininode_loop.stop()
+
+    def queue_callback(self, callback, *args):
+        """Run callback(*args) on a delivery thread, after the callbacks
+        queued before it for the same NodeConnCB."""
+        self.cb.delivery_queue.put(callback, *args)
+
+    def call_locked(self, callback, *args):
+        # NodeConnCB.deliver takes these locks itself
+        with mininode_lock.shared(), self.cb.lock:
+            callback(*args)
+
+    def write_data(self, buffers):
+        if self.state == "closed":
+            return
+        for b in buffers:
+            self.send_queue.append(memoryview(b))
+            self.send_queue_bytes += len(b)
+        self.send_queue_peak = max(self.send_queue_peak, self.send_queue_bytes)
+        self.flush_send_queue()
+
+    def flush_send_queue(self):
+        # Hand queued buffers to the transport in batches that fill it up to
+        # SEND_BUFFER_HIGH_WATER, so it never holds much more than that.
+        # Each batch goes out with a single writelines(); the batch that
+        # crosses the limit makes the transport call pause_writing(), and
+        # resume_writing() flushes the rest once it has drained.
+        if self.state != "connected":
+            return
+        while self.send_queue and not self.write_paused:
+            room = SEND_BUFFER_HIGH_WATER - self.transport.get_write_buffer_size()
+            buffers = []
+            while self.send_queue and (room > 0 or not buffers):
+                b = self.send_queue.popleft()
+                self.send_queue_bytes -= len(b)
+                room -= len(b)
+                buffers.append(b)
+            self.transport.writelines(buffers)
+
+    def get_send_buffer_size(self):
+        """Bytes sent with send_message that haven't been written to the socket yet."""
+        size = self.send_queue_bytes
+        if self.transport is not None:
+            size += self.transport.get_write_buffer_size()
+        return size
 
     def got_data(self):
         try:
+            buf = self.recvbuf
+            magic = self.MAGIC_BYTES[self.network]
+            # Old peers don't send checksums
+            header_size = 4 + 12 + 4 if self.ver_recv < 209 else 4 + 12 + 4 + 4
             while True:
-                if len(self.recvbuf) < 4:
+                pos = self.recv_start
+                available = self.recv_end - pos
+                if available < 4:
                     return
-                if self.recvbuf[:4] != self.MAGIC_BYTES[self.network]:
-                    raise ValueError("got garbage %s" % repr(self.recvbuf))
-                if self.ver_recv < 209:
-                    if len(self.recvbuf) < 4 + 12 + 4:
-                        return
-                    command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                    checksum = None
-                    if len(self.recvbuf) < 4 + 12 + 4 + msglen:
-                        return
-                    msg = self.recvbuf[4+12+4:4+12+4+msglen]
-                    self.recvbuf = self.recvbuf[4+12+4+msglen:]
-                else:
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                        return
-                    command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                    checksum = self.recvbuf[4+12+4:4+12+4+4]
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                        return
-                    msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                    th = sha256(msg)
-                    h = sha256(th)
-                    if checksum != h[:4]:
-                        raise ValueError("got bad checksum " + repr(self.recvbuf))
-                    self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if command in self.messagemap:
-                    f = BytesIO(msg)
+                if buf[pos:pos+4] != magic:
+                    raise ValueError("got garbage %s" % repr(bytes(buf[pos:self.recv_end])))
+                if available < header_size:
+                    return
+                command = bytes(buf[pos+4:pos+4+12]).split(b"\x00", 1)[0]
+                msglen = struct_int32.unpack_from(buf, pos+4+12)[0]
+                if available < header_size + msglen:
+                    return
+                start = pos + header_size
+                msg = memoryview(buf)[start:start+msglen]
+                eager = command in self.eager_commands
+                checksum = None
+                if header_size > 4 + 12 + 4:
+                    checksum = bytes(buf[pos+4+12+4:pos+4+12+4+4])
+                    self.checksum_count += 1
+                    if self.checksums == "sample":
+                        verify = self.checksum_count % CHECKSUM_SAMPLE_INTERVAL == 1
+                    else:
+                        # In lazy mode, messages decoded right away are checked right away
+                        verify = self.checksums == "always" or eager
+                    if verify and hash256(msg)[:4] != checksum:
+                        raise ValueError("got bad checksum " + repr(bytes(buf[pos:self.recv_end])))
+                    if verify or self.checksums != "lazy":
+                        checksum = None
+                self.recv_start = start + msglen
+                if eager and command in self.messagemap:
                     t = self.messagemap[command]()
-                    t.deserialize(f)
+                    t.deserialize(ByteReader(msg))
                     self.got_message(t)
+                elif command in self.messagemap:
+                    # The payload is copied out of recvbuf, which gets reused
+                    self.got_message(lazy_message(self.messagemap[command], msg.tobytes(), checksum))
                 else:
-                    logger.warning("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg)))
+                    logger.warning("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(bytes(msg))))
+                # ver_recv changes when the verack is delivered
+                header_size = 4 + 12 + 4 if self.ver_recv < 209 else 4 + 12 + 4 + 4
         except Exception as e:
             logger.exception('got_data:', repr(e))
 
     def send_message(self, message, pushbuf=False):
         if self.state != "connected" and not pushbuf:
             raise IOError('Not connected, no pushbuf')
-        logger.debug("Send message to %s:%d: %s" % (self.dstaddr, self.dstport, repr(message)))
         command = message.command
         data = message.serialize()
-        tmsg = self.MAGIC_BYTES[self.network]
-        tmsg += command
-        tmsg += b"\x00" * (12 - len(command))
-        tmsg += struct.pack("<I", len(data))
+        if logger.isEnabledFor(logging.DEBUG):
+            # The repr of a large block costs more than sending it
+            logger.debug("Send message to %s:%d: %s (%d bytes)" % (self.dstaddr, self.dstport, command.decode('ascii'), len(data)))
+        header = self.MAGIC_BYTES[self.network]
+        header += command
+        header += b"\x00" * (12 - len(command))
+        header += struct.pack("<I", len(data))
         if self.ver_send >= 209:
             th = sha256(data)
             h = sha256(th)
-            tmsg += h[:4]
-        tmsg += data
-        with mininode_lock:
-            self.sendbuf += tmsg
-            self.last_sent = time.time()
+            header += h[:4]
+        self.last_sent = time.time()
+        # Queued from the network thread, in the order messages were sent
+        mininode_loop.call_soon_threadsafe(self.write_data, (header, data))
 
     def got_message(self, message):
         if message.command == b"version":
@@ -1766,25 +2614,26 @@ class NodeConn(asyncore.dispatcher):
                 self.messagemap[b'ping'] = msg_ping_prebip31
         if self.last_sent + 30 * 60 < time.time():
             self.send_message(self.messagemap[b'ping']())
-        logger.debug("Received message from %s:%d: %s" % (self.dstaddr, self.dstport, repr(message)))
-        self.cb.deliver(self, message)
+        if logger.isEnabledFor(logging.DEBUG):
+            # Doesn't decode a LazyMessage
+            logger.debug("Received message from %s:%d: %s" % (self.dstaddr, self.dstport, repr(message)))
+        self.queue_callback(self.cb.deliver, self, message)
 
     def disconnect_node(self):
         self.disconnect = True
+        mininode_loop.call_soon_threadsafe(self.handle_close)
 
 
 class NetworkThread(Thread):
     def run(self):
-        while mininode_socket_map:
-            # We check for whether to disconnect outside of the asyncore
-            # loop to workaround the behavior of asyncore when using
-            # select
-            disconnected = []
-            for fd, obj in mininode_socket_map.items():
-                if obj.disconnect:
-                    disconnected.append(obj)
-            [ obj.handle_close() for obj in disconnected ]
-            asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
+        # NodeConn.handle_close stops the loop once the last connection
+        # closes.  Connections made while the previous thread was still
+        # running may already have been served and closed by it.
+        with mininode_loop_lock:
+            with mininode_connections_lock:
+                if not mininode_connections:
+                    return
+            mininode_loop.run_forever()
 
 
 # An exception we can raise if we detect a potential disconnect
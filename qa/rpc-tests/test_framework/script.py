@@ -7,7 +7,7 @@
 This file is modified from python-bitcoinlib.
 """
 
-from .mininode import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string
+from .mininode import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string, ser_compact_size
 from binascii import hexlify
 import hashlib
 
@@ -853,73 +853,89 @@ def SignatureHash(script, txTo, inIdx, hashtype):
 
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
 
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
+    basetype = hashtype & 0x1f
+    if basetype == SIGHASH_SINGLE and inIdx >= len(txTo.vout):
+        return (HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, len(txTo.vout)))
 
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
+    # Serialize txTo as it looks after the modifications hashtype asks for,
+    # without copying it: other inputs get an empty scriptSig (and, for
+    # SIGHASH_NONE and SIGHASH_SINGLE, a zero nSequence), and the outputs
+    # are dropped or, for SIGHASH_SINGLE, all but the matching one blanked.
+    s = bytearray(struct.pack("<i", txTo.nVersion))
 
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+    if hashtype & SIGHASH_ANYONECANPAY:
+        inputs = [inIdx]
+    else:
+        inputs = range(len(txTo.vin))
+    s += ser_compact_size(len(inputs))
+    zero_sequence = basetype in (SIGHASH_NONE, SIGHASH_SINGLE)
+    for i in inputs:
+        txin = txTo.vin[i]
+        s += txin.prevout.serialize()
+        if i == inIdx:
+            s += ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR])))
+            s += struct.pack("<I", txin.nSequence)
+        else:
+            s += ser_string(b'')
+            s += struct.pack("<I", 0 if zero_sequence else txin.nSequence)
+
+    if basetype == SIGHASH_NONE:
+        s += ser_compact_size(0)
+    elif basetype == SIGHASH_SINGLE:
+        s += ser_compact_size(inIdx + 1)
+        s += CTxOut(-1).serialize() * inIdx
+        s += txTo.vout[inIdx].serialize()
+    else:
+        s += ser_compact_size(len(txTo.vout))
+        for txout in txTo.vout:
+            s += txout.serialize()
+
+    s += struct.pack("<I", txTo.nLockTime)
+    s += struct.pack(b"<I", hashtype)
 
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
+    hash = hash256(s)
 
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
+    return (hash, None)
 
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+def GetPrevoutHash(txTo):
+    return uint256_from_str(hash256(b"".join(i.prevout.serialize() for i in txTo.vin)))
 
-    if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
+def GetSequenceHash(txTo):
+    return uint256_from_str(hash256(b"".join(struct.pack("<I", i.nSequence) for i in txTo.vin)))
 
-    s = txtmp.serialize()
-    s += struct.pack(b"<I", hashtype)
+def GetOutputsHash(txTo):
+    return uint256_from_str(hash256(b"".join(o.serialize() for o in txTo.vout)))
 
-    hash = hash256(s)
+class PrecomputedTransactionData(object):
+    """Hashes shared by the version 1 signature hashes of all inputs of a
+    transaction.
 
-    return (hash, None)
+    Build it once the inputs' outpoints and sequence numbers and the outputs
+    are final, and pass it to SegwitVersion1SignatureHash for each input.
+    Witnesses and scriptSigs may still change.
+    """
+    def __init__(self, txTo):
+        self.hashPrevouts = GetPrevoutHash(txTo)
+        self.hashSequence = GetSequenceHash(txTo)
+        self.hashOutputs = GetOutputsHash(txTo)
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
 # for version 0 witnesses.
-def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
+def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount, cache=None):
 
     hashPrevouts = 0
     hashSequence = 0
     hashOutputs = 0
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
+        hashPrevouts = cache.hashPrevouts if cache is not None else GetPrevoutHash(txTo)
 
     if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
+        hashSequence = cache.hashSequence if cache is not None else GetSequenceHash(txTo)
 
     if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+        hashOutputs = cache.hashOutputs if cache is not None else GetOutputsHash(txTo)
     elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
         serialize_outputs = txTo.vout[inIdx].serialize()
         hashOutputs = uint256_from_str(hash256(serialize_outputs))
@@ -5,8 +5,17 @@
 """Specialized SipHash-2-4 implementations.
 
 This implements SipHash-2-4 for 256-bit integers.
+
+siphash256_many() hashes a batch of integers under one key.  It uses NumPy
+when that is installed and the batch is large enough to benefit; otherwise it
+only saves setting up the key for every hash.
 """
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def rotl64(n, b):
     return n >> (64 - b) | (n & ((1 << (64 - b)) - 1)) << b
 
@@ -28,36 +37,93 @@ def siphash_round(v0, v1, v2, v3):
     return (v0, v1, v2, v3)
 
 def siphash256(k0, k1, h):
-    n0 = h & ((1 << 64) - 1)
-    n1 = (h >> 64) & ((1 << 64) - 1)
-    n2 = (h >> 128) & ((1 << 64) - 1)
-    n3 = (h >> 192) & ((1 << 64) - 1)
-    v0 = 0x736f6d6570736575 ^ k0
-    v1 = 0x646f72616e646f6d ^ k1
-    v2 = 0x6c7967656e657261 ^ k0
-    v3 = 0x7465646279746573 ^ k1 ^ n0
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0 ^= n0
-    v3 ^= n1
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0 ^= n1
-    v3 ^= n2
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0 ^= n2
-    v3 ^= n3
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0 ^= n3
-    v3 ^= 0x2000000000000000
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0 ^= 0x2000000000000000
-    v2 ^= 0xFF
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
-    v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
+    return _siphash256_keyed(_siphash_init(k0, k1), h)
+
+def _siphash_init(k0, k1):
+    return (0x736f6d6570736575 ^ k0, 0x646f72616e646f6d ^ k1,
+            0x6c7967656e657261 ^ k0, 0x7465646279746573 ^ k1)
+
+def _siphash256_keyed(init, h):
+    # siphash256 from the state _siphash_init set up for the key, with the
+    # rounds inlined to save a function call each.
+    mask = (1 << 64) - 1
+    v0, v1, v2, v3 = init
+    for m, rounds in ((h & mask, 2), ((h >> 64) & mask, 2),
+                      ((h >> 128) & mask, 2), ((h >> 192) & mask, 2),
+                      (0x2000000000000000, 2), (None, 4)):
+        if m is None:
+            v2 ^= 0xFF
+        else:
+            v3 ^= m
+        for _ in range(rounds):
+            v0 = (v0 + v1) & mask
+            v1 = ((v1 << 13) & mask | v1 >> 51) ^ v0
+            v0 = (v0 << 32) & mask | v0 >> 32
+            v2 = (v2 + v3) & mask
+            v3 = ((v3 << 16) & mask | v3 >> 48) ^ v2
+            v0 = (v0 + v3) & mask
+            v3 = ((v3 << 21) & mask | v3 >> 43) ^ v0
+            v2 = (v2 + v1) & mask
+            v1 = ((v1 << 17) & mask | v1 >> 47) ^ v2
+            v2 = (v2 << 32) & mask | v2 >> 32
+        if m is not None:
+            v0 ^= m
     return v0 ^ v1 ^ v2 ^ v3
+
+# Below this many hashes, converting to and from NumPy arrays costs more than
+# it saves.
+NUMPY_MIN_BATCH = 64
+
+def siphash256_many(k0, k1, hashes, use_numpy=None):
+    """Return [siphash256(k0, k1, h) for h in hashes].
+
+    use_numpy=None picks the NumPy implementation for large batches if NumPy
+    is available; True or False forces the choice.
+    """
+    hashes = list(hashes)
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(hashes) >= NUMPY_MIN_BATCH
+    if use_numpy:
+        return _siphash256_many_numpy(k0, k1, hashes)
+    return _siphash256_many_python(k0, k1, hashes)
+
+def _siphash256_many_python(k0, k1, hashes):
+    init = _siphash_init(k0, k1)
+    return [_siphash256_keyed(init, h) for h in hashes]
+
+def _siphash256_many_numpy(k0, k1, hashes):
+    # One uint64 lane per hash; additions wrap modulo 2^64 on their own.
+    u64 = numpy.uint64
+    words = numpy.frombuffer(b"".join(h.to_bytes(32, 'little') for h in hashes), dtype='<u8').reshape(-1, 4)
+    shape = (len(hashes),)
+    v0, v1, v2, v3 = (numpy.full(shape, v, dtype=u64) for v in _siphash_init(k0, k1))
+
+    def rotl(x, b):
+        return (x << u64(b)) | (x >> u64(64 - b))
+
+    def sipround(v0, v1, v2, v3):
+        v0 += v1
+        v1 = rotl(v1, 13)
+        v1 ^= v0
+        v0 = rotl(v0, 32)
+        v2 += v3
+        v3 = rotl(v3, 16)
+        v3 ^= v2
+        v0 += v3
+        v3 = rotl(v3, 21)
+        v3 ^= v0
+        v2 += v1
+        v1 = rotl(v1, 17)
+        v1 ^= v2
+        v2 = rotl(v2, 32)
+        return (v0, v1, v2, v3)
+
+    for m in (words[:, 0], words[:, 1], words[:, 2], words[:, 3], u64(0x2000000000000000)):
+        v3 ^= m
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+        v0 ^= m
+    v2 ^= u64(0xFF)
+    for _ in range(4):
+        v0, v1, v2, v3 = sipround(v0, v1, v2, v3)
+    return (v0 ^ v1 ^ v2 ^ v3).tolist()
@@ -33,6 +33,9 @@ class BitcoinTestFramework(object):
     def __init__(self):
         self.num_nodes = 4
         self.setup_clean_chain = False
+        # Cached chain to start from unless setup_clean_chain is set; see
+        # chaincache.VARIANTS
+        self.cache_variant = "200-block"
         self.nodes = None
 
     def run_test(self):
@@ -46,7 +49,7 @@ class BitcoinTestFramework(object):
         if self.setup_clean_chain:
             initialize_chain_clean(self.options.tmpdir, self.num_nodes)
         else:
-            initialize_chain(self.options.tmpdir, self.num_nodes, self.options.cachedir)
+            initialize_chain(self.options.tmpdir, self.num_nodes, self.options.cachedir, self.cache_variant)
 
     def stop_node(self, num_node):
         stop_node(self.nodes[num_node], num_node)
@@ -20,6 +20,12 @@ import time
 import re
 import errno
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from . import coverage
 from .authproxy import AuthServiceProxy, JSONRPCException
@@ -146,33 +152,92 @@ def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     raise AssertionError("Block sync to height {} timed out:{}".format(
                          maxheight, "".join("\n  {!r}".format(tip) for tip in tips)))
 
-def sync_chain(rpc_connections, *, wait=1, timeout=60):
+# Shortest interval between polls in sync_chain and sync_mempools; it
+# doubles each time nothing changed, up to their wait argument.
+SYNC_POLL_INTERVAL_MIN = 0.005
+
+class ZMQNotifier(object):
+    """
+    Subscription to the -zmqpubhashblock/-zmqpubhashtx notifications of some
+    nodes, which sync_chain and sync_mempools can use to poll again as soon
+    as anything changes rather than after their polling interval.
+    Needs the zmq module, and nodes started with matching -zmqpub* options.
+    """
+
+    def __init__(self, addresses, topics=(b"hashblock", b"hashtx")):
+        import zmq
+        self.zmq = zmq
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        for topic in topics:
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        for address in addresses:
+            self.socket.connect(address)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for notifications; return whether any arrived."""
+        if not self.socket.poll(int(timeout * 1000)):
+            return False
+        while self.socket.poll(0):
+            self.socket.recv_multipart()
+        return True
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
+
+def _sync_polls(wait, timeout, notifier):
+    """
+    Yield once per poll until timeout, backing off exponentially from
+    SYNC_POLL_INTERVAL_MIN to wait between polls.  With a notifier, the
+    next poll starts as soon as a notification arrives.
+    """
+    deadline = time.time() + timeout
+    interval = SYNC_POLL_INTERVAL_MIN
+    while True:
+        yield
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        if notifier is not None and notifier.wait(min(interval, remaining)):
+            interval = SYNC_POLL_INTERVAL_MIN
+        else:
+            if notifier is None:
+                time.sleep(min(interval, remaining))
+            interval = min(interval * 2, wait)
+
+def sync_chain(rpc_connections, *, wait=0.1, timeout=60, notifier=None):
     """
     Wait until everybody has the same best block
     """
-    while timeout > 0:
+    for _ in _sync_polls(wait, timeout, notifier):
         best_hash = [x.getbestblockhash() for x in rpc_connections]
         if best_hash == [best_hash[0]]*len(best_hash):
             return
-        time.sleep(wait)
-        timeout -= wait
     raise AssertionError("Chain sync failed: Best block hashes don't match")
 
-def sync_mempools(rpc_connections, *, wait=1, timeout=60):
+def mempool_size(rpc_connection):
+    """Number of transactions and their total size in a node's mempool."""
+    info = rpc_connection.getmempoolinfo()
+    return (info["size"], info["bytes"])
+
+def sync_mempools(rpc_connections, *, wait=0.1, timeout=60, notifier=None):
     """
     Wait until everybody has the same transactions in their memory
     pools
     """
-    while timeout > 0:
+    for _ in _sync_polls(wait, timeout, notifier):
+        # getmempoolinfo is much smaller than getrawmempool, so the txids
+        # are only fetched once every node reports the same size and byte
+        # count, and not at all when the mempools are empty.
+        size = mempool_size(rpc_connections[0])
+        if not all(mempool_size(x) == size for x in rpc_connections[1:]):
+            continue
+        if size[0] == 0:
+            return
         pool = set(rpc_connections[0].getrawmempool())
-        num_match = 1
-        for i in range(1, len(rpc_connections)):
-            if set(rpc_connections[i].getrawmempool()) == pool:
-                num_match = num_match+1
-        if num_match == len(rpc_connections):
+        if all(set(x.getrawmempool()) == pool for x in rpc_connections[1:]):
             return
-        time.sleep(wait)
-        timeout -= wait
     raise AssertionError("Mempool sync failed")
 
 bitcoind_processes = {}
@@ -206,98 +271,153 @@ def rpc_url(i, rpchost=None):
             host = rpchost
     return "http://%s:%s@%s:%d" % (rpc_u, rpc_p, host, int(port))
 
-def wait_for_bitcoind_start(process, url, i):
+# Logged by bitcoind once initialization is complete and RPC warmup is over
+INIT_COMPLETE_MESSAGE = b"init message: Done loading"
+# How often debug.log is checked for INIT_COMPLETE_MESSAGE
+START_LOG_POLL_INTERVAL = 0.01
+# Bounds of the exponential backoff between RPC attempts during startup
+START_RPC_RETRY_MIN = 0.02
+START_RPC_RETRY_MAX = 0.5
+
+class LogTail(object):
+    """Follow a log file from a given offset, looking for a message."""
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        self.tail = b""
+
+    def find(self, message):
+        """Return whether message was logged since the last call (or the start offset)."""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        self.offset += len(data)
+        # Keep enough of the previous read to match across reads
+        data = self.tail + data
+        self.tail = data[-len(message):]
+        return message in data
+
+def log_offset(path):
+    """Return the current size of a log file, so that it can be tailed from there."""
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+def wait_for_bitcoind_start(process, url, i, log_file=None, log_start=0):
     '''
     Wait for bitcoind to start. This means that RPC is accessible and fully initialized.
     Raise an exception if bitcoind exits during initialization.
+
+    If log_file (the node's debug.log) is given, it is tailed from offset
+    log_start and RPC is tried as soon as the init-complete message shows up.
+    RPC is also retried with exponential backoff, in case it never does.
     '''
+    tail = LogTail(log_file, log_start) if log_file else None
+    rpc = None
+    retry = START_RPC_RETRY_MIN
+    next_attempt = time.time()
     while True:
         if process.poll() is not None:
             raise Exception('bitcoind exited with status %i during initialization' % process.returncode)
-        try:
-            rpc = get_rpc_proxy(url, i)
-            blocks = rpc.getblockcount()
-            break # break out of loop on success
-        except IOError as e:
-            if e.errno != errno.ECONNREFUSED: # Port not yet open?
-                raise # unknown IO error
-        except JSONRPCException as e: # Initialization phase
-            if e.error['code'] != -28: # RPC in warmup?
-                raise # unknown JSON RPC exception
-        time.sleep(0.25)
-
-def initialize_chain(test_dir, num_nodes, cachedir):
-    """
-    Create a cache of a 200-block-long chain (with wallet) for MAX_NODES
-    Afterward, create num_nodes copies from the cache
-    """
-
-    assert num_nodes <= MAX_NODES
-    create_cache = False
-    for i in range(MAX_NODES):
-        if not os.path.isdir(os.path.join(cachedir, 'node'+str(i))):
-            create_cache = True
-            break
-
-    if create_cache:
-        logger.debug("Creating data directories from cached datadir")
-
-        #find and delete old cache directories if any exist
-        for i in range(MAX_NODES):
-            if os.path.isdir(os.path.join(cachedir,"node"+str(i))):
-                shutil.rmtree(os.path.join(cachedir,"node"+str(i)))
-
-        # Create cache directories, run bitcoinds:
-        for i in range(MAX_NODES):
-            datadir=initialize_datadir(cachedir, i)
-            args = [ os.getenv("BITCOIND", "bitcoind"), "-server", "-keypool=1", "-datadir="+datadir, "-discover=0" ]
-            if i > 0:
-                args.append("-connect=127.0.0.1:"+str(p2p_port(0)))
-            bitcoind_processes[i] = subprocess.Popen(args)
-            logger.debug("initialize_chain: bitcoind started, waiting for RPC to come up")
-            wait_for_bitcoind_start(bitcoind_processes[i], rpc_url(i), i)
-            logger.debug("initialize_chain: RPC successfully started")
-
-        rpcs = []
-        for i in range(MAX_NODES):
+        logged_ready = tail is not None and tail.find(INIT_COMPLETE_MESSAGE)
+        if logged_ready or time.time() >= next_attempt:
             try:
-                rpcs.append(get_rpc_proxy(rpc_url(i), i))
-            except:
-                sys.stderr.write("Error connecting to "+url+"\n")
-                sys.exit(1)
-
-        # Create a 200-block-long chain; each of the 4 first nodes
-        # gets 25 mature blocks and 25 immature.
-        # Note: To preserve compatibility with older versions of
-        # initialize_chain, only 4 nodes will generate coins.
-        #
-        # blocks are created with timestamps 10 minutes apart
-        # starting from 2010 minutes in the past
-        enable_mocktime()
-        block_time = get_mocktime() - (201 * 10 * 60)
-        for i in range(2):
-            for peer in range(4):
-                for j in range(25):
-                    set_node_times(rpcs, block_time)
-                    rpcs[peer].generate(1)
-                    block_time += 10*60
-                # Must sync before next peer starts generating blocks
-                sync_blocks(rpcs)
-
-        # Shut them down, and clean up cache directories:
-        stop_nodes(rpcs)
-        disable_mocktime()
-        for i in range(MAX_NODES):
-            os.remove(log_filename(cachedir, i, "debug.log"))
-            os.remove(log_filename(cachedir, i, "db.log"))
-            os.remove(log_filename(cachedir, i, "peers.dat"))
-            os.remove(log_filename(cachedir, i, "fee_estimates.dat"))
+                if rpc is None:
+                    rpc = get_rpc_proxy(url, i)
+                rpc.getblockcount()
+                return # RPC is up and warmup is over
+            except IOError as e:
+                if e.errno != errno.ECONNREFUSED: # Port not yet open?
+                    raise # unknown IO error
+                rpc = None # the connection can't be reused after a failed connect
+            except JSONRPCException as e: # Initialization phase
+                if e.error['code'] != -28: # RPC in warmup?
+                    raise # unknown JSON RPC exception
+            next_attempt = time.time() + retry
+            retry = min(retry * 2, START_RPC_RETRY_MAX)
+        time.sleep(START_LOG_POLL_INTERVAL if tail is not None else max(next_attempt - time.time(), 0))
+
+# ioctl from linux/fs.h that makes a file share another file's extents
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+def _reflink(src, dst):
+    """Create dst as a copy-on-write clone of src, if the filesystem can."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+def _immutable_files(dirname, filenames):
+    """
+    Files in dirname that bitcoind never modifies in place.
+    Only the highest numbered blk/rev file is still appended to, and leveldb
+    tables (*.ldb) are written once and then only ever deleted.
+    """
+    immutable = set(f for f in filenames if f.endswith(".ldb"))
+    if os.path.basename(dirname) == "blocks":
+        for prefix in ("blk", "rev"):
+            numbered = sorted(f for f in filenames if re.match(prefix + r"\d{5}\.dat$", f))
+            immutable.update(numbered[:-1])
+    return immutable
+
+def provision_datadir(from_dir, to_dir):
+    """
+    Copy the datadir from_dir to to_dir as cheaply as the filesystem allows.
 
-    for i in range(num_nodes):
-        from_dir = os.path.join(cachedir, "node"+str(i))
-        to_dir = os.path.join(test_dir,  "node"+str(i))
-        shutil.copytree(from_dir, to_dir)
-        initialize_datadir(test_dir, i) # Overwrite port/rpcport in bitcoin.conf
+    Every file is reflinked (FICLONE) where supported.  Otherwise files
+    that bitcoind never writes to are hardlinked, and the rest copied.
+
+    Returns a dict counting the files provisioned each way, their total
+    size in bytes and the elapsed time in seconds.
+    """
+    start = time.time()
+    stats = {"reflink": 0, "hardlink": 0, "copy": 0, "bytes": 0}
+    try_reflink = fcntl is not None
+    for dirname, subdirs, filenames in os.walk(from_dir):
+        target = os.path.join(to_dir, os.path.relpath(dirname, from_dir))
+        os.makedirs(target, exist_ok=True)
+        immutable = _immutable_files(dirname, filenames)
+        for f in filenames:
+            src = os.path.join(dirname, f)
+            dst = os.path.join(target, f)
+            stats["bytes"] += os.path.getsize(src)
+            if try_reflink:
+                try:
+                    _reflink(src, dst)
+                    stats["reflink"] += 1
+                    continue
+                except OSError:
+                    # Not supported by this filesystem, don't try again
+                    try_reflink = False
+            if f in immutable:
+                try:
+                    if os.path.exists(dst):
+                        os.remove(dst) # left by the failed reflink
+                    os.link(src, dst)
+                    stats["hardlink"] += 1
+                    continue
+                except OSError:
+                    pass # e.g. from_dir on another filesystem
+            shutil.copy2(src, dst)
+            stats["copy"] += 1
+    stats["time"] = time.time() - start
+    logger.debug("Provisioned %s from %s in %.3fs: %d reflinked, %d hardlinked, %d copied, %d bytes" %
+                 (to_dir, from_dir, stats["time"], stats["reflink"], stats["hardlink"], stats["copy"], stats["bytes"]))
+    return stats
+
+def initialize_chain(test_dir, num_nodes, cachedir, variant="200-block", **params):
+    """
+    Create num_nodes datadirs in test_dir from a cached chain (with wallet),
+    generating the cache first if needed.  See chaincache.VARIANTS for the
+    available chains; by default this is the 200-block-long chain.
+    """
+    # Imported here as chaincache itself is built on this module
+    from .chaincache import DatadirCache
+    DatadirCache(cachedir).provision(test_dir, num_nodes, variant, **params)
 
 def initialize_chain_clean(test_dir, num_nodes):
     """
@@ -308,19 +428,28 @@ def initialize_chain_clean(test_dir, num_nodes):
         datadir=initialize_datadir(test_dir, i)
 
 
-def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None, stderr=None):
+def launch_node(i, dirname, extra_args=None, binary=None, stderr=None):
     """
-    Start a bitcoind and return RPC connection to it
+    Start a bitcoind without waiting for it.
+    Returns the (debug.log path, offset) to pass to wait_for_bitcoind_start.
     """
     datadir = os.path.join(dirname, "node"+str(i))
     if binary is None:
         binary = os.getenv("BITCOIND", "bitcoind")
     args = [ binary, "-datadir="+datadir, "-server", "-keypool=1", "-discover=0", "-rest", "-logtimemicros", "-debug", "-mocktime="+str(get_mocktime()) ]
     if extra_args is not None: args.extend(extra_args)
+    debug_log = log_filename(dirname, i, "debug.log")
+    log_start = log_offset(debug_log)
     bitcoind_processes[i] = subprocess.Popen(args, stderr=stderr)
     logger.debug("initialize_chain: bitcoind started, waiting for RPC to come up")
+    return debug_log, log_start
+
+def wait_for_node(i, debug_log, log_start, rpchost=None, timewait=None):
+    """
+    Wait for a bitcoind started by launch_node and return RPC connection to it
+    """
     url = rpc_url(i, rpchost)
-    wait_for_bitcoind_start(bitcoind_processes[i], url, i)
+    wait_for_bitcoind_start(bitcoind_processes[i], url, i, debug_log, log_start)
     logger.debug("initialize_chain: RPC successfully started")
     proxy = get_rpc_proxy(url, i, timeout=timewait)
 
@@ -329,6 +458,29 @@ def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=
 
     return proxy
 
+def start_node(i, dirname, extra_args=None, rpchost=None, timewait=None, binary=None, stderr=None):
+    """
+    Start a bitcoind and return RPC connection to it
+    """
+    debug_log, log_start = launch_node(i, dirname, extra_args, binary, stderr)
+    return wait_for_node(i, debug_log, log_start, rpchost, timewait)
+
+def start_node_from_block_files(i, dirname, block_files, height, extra_args=None, timeout=60, **kwargs):
+    """
+    Start a bitcoind that imports block_files (such as written by
+    blocktools.ChainBuilder.write_block_files) with -loadblock, and return
+    RPC connection to it once its chain has reached height
+    """
+    args = list(extra_args or []) + ["-loadblock="+f for f in block_files]
+    node = start_node(i, dirname, args, **kwargs)
+    start_time = time.time()
+    tip = node.waitforblockheight(height, 0)
+    while tip["height"] < height and time.time() <= start_time + timeout:
+        tip = node.waitforblockheight(height, 1000)
+    if tip["height"] < height:
+        raise AssertionError("Block import to height {} timed out: {!r}".format(height, tip))
+    return node
+
 def assert_start_raises_init_error(i, dirname, extra_args=None, expected_msg=None):
     with tempfile.SpooledTemporaryFile(max_size=2**16) as log_stderr:
         try:
@@ -354,11 +506,16 @@ def start_nodes(num_nodes, dirname, extra_args=None, rpchost=None, timewait=None
     """
     if extra_args is None: extra_args = [ None for _ in range(num_nodes) ]
     if binary is None: binary = [ None for _ in range(num_nodes) ]
+    logs = []
     rpcs = []
     try:
+        # Launch them all first so that they initialize in parallel
         for i in range(num_nodes):
-            rpcs.append(start_node(i, dirname, extra_args[i], rpchost, timewait=timewait, binary=binary[i]))
+            logs.append(launch_node(i, dirname, extra_args[i], binary[i]))
+        for i in range(num_nodes):
+            rpcs.append(wait_for_node(i, logs[i][0], logs[i][1], rpchost, timewait))
     except: # If one node failed to start, stop the others
+        kill_nodes(range(len(rpcs), len(logs)))
         stop_nodes(rpcs)
         raise
     return rpcs
@@ -366,20 +523,47 @@ def start_nodes(num_nodes, dirname, extra_args=None, rpchost=None, timewait=None
 def log_filename(dirname, n_node, logname):
     return os.path.join(dirname, "node"+str(n_node), "regtest", logname)
 
-def stop_node(node, i):
+def _stop_bitcoind(node, i, deadline):
+    """Ask node i to stop and wait for it to exit, until deadline. Returns the shutdown latency."""
     logger.debug("Stopping node %d" % i)
+    start = time.time()
     try:
         node.stop()
     except http.client.CannotSendRequest as e:
         logger.exception("Unable to stop node")
-    return_code = bitcoind_processes[i].wait(timeout=BITCOIND_PROC_WAIT_TIMEOUT)
+    return_code = bitcoind_processes[i].wait(timeout=max(deadline - time.time(), 0))
     assert_equal(return_code, 0)
     del bitcoind_processes[i]
+    return time.time() - start
+
+def stop_node(node, i):
+    _stop_bitcoind(node, i, time.time() + BITCOIND_PROC_WAIT_TIMEOUT)
 
 def stop_nodes(nodes):
-    for i, node in enumerate(nodes):
-        stop_node(node, i)
+    """
+    Stop all nodes concurrently, within BITCOIND_PROC_WAIT_TIMEOUT in total.
+    Returns the shutdown latency of each node, in seconds.
+    """
+    latencies = []
+    if nodes:
+        start = time.time()
+        deadline = start + BITCOIND_PROC_WAIT_TIMEOUT
+        with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+            futures = [executor.submit(_stop_bitcoind, node, i, deadline) for i, node in enumerate(nodes)]
+        # Every node has been waited for; raise the first failure, if any
+        latencies = [f.result() for f in futures]
+        logger.debug("Stopped %d nodes in %.3fs (%s)" % (len(nodes), time.time() - start,
+                     ", ".join("node%d %.3fs" % (i, t) for i, t in enumerate(latencies))))
     assert not bitcoind_processes.values() # All connections must be gone now
+    return latencies
+
+def kill_nodes(indices):
+    """Kill bitcoinds that were launched but never came up, and reap them."""
+    for i in indices:
+        process = bitcoind_processes.pop(i, None)
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait(timeout=BITCOIND_PROC_WAIT_TIMEOUT)
 
 def set_node_times(nodes, t):
     for node in nodes: